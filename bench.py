@@ -0,0 +1,787 @@
+"""Offline benchmark for the bot: drives the spin buttons, admin commands, member joins and
+storage against fake Discord objects, without a token or network access.
+
+    python bench.py --guilds 20 --users 500 --spins 5000 --output results.json
+
+Prints one JSON document (to stdout or --output) so runs can be compared between versions.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for main.py")
+    parser.add_argument("--backend", choices=["json", "sqlite", "files"], default="json",
+                        help="storage backend (BOT_STORAGE): one JSON file, SQLite or one file per guild")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200, help="members per guild")
+    parser.add_argument("--spins", type=int, default=2000)
+    parser.add_argument("--stress-spins", type=int, default=5000, help="concurrent spins in the counter consistency check")
+    parser.add_argument("--stress-users", type=int, default=20, help="users per guild in the counter consistency check")
+    parser.add_argument("--admin-ops", type=int, default=500)
+    parser.add_argument("--joins", type=int, default=1000)
+    parser.add_argument("--bulk-rows", type=int, default=20000, help="rows in the /bulk-invites file")
+    parser.add_argument("--invites", type=int, default=20, help="invite links per guild")
+    parser.add_argument("--prizes", type=int, default=50, help="prizes on each wheel")
+    parser.add_argument("--draws", type=int, default=100000, help="draws for the prize distribution check")
+    parser.add_argument("--file-guilds", type=int, default=100, help="guilds in the data-file scenario")
+    parser.add_argument("--file-users", type=int, default=500, help="users per guild in the data-file scenario")
+    parser.add_argument("--layout-guilds", type=lambda text: [int(n) for n in text.split(",")], default=[1000, 10000],
+                        help="guild counts for the storage layout comparison, comma-separated")
+    parser.add_argument("--layout-users", type=int, default=20, help="users per guild in the storage layout comparison")
+    parser.add_argument("--memory-guilds", type=lambda text: [int(n) for n in text.split(",")], default=[1000, 10000],
+                        help="guild counts for the in-memory layout comparison, comma-separated")
+    parser.add_argument("--memory-users", type=int, default=100,
+                        help="users per guild in the in-memory layout comparison (1000 needs several GB for the dict layout at 10k guilds)")
+    parser.add_argument("--fixture-large", type=int, default=4, help="large guilds in the member cache fixture")
+    parser.add_argument("--fixture-large-members", type=int, default=25000)
+    parser.add_argument("--fixture-small", type=int, default=500, help="small guilds in the member cache fixture")
+    parser.add_argument("--fixture-small-members", type=int, default=50)
+    parser.add_argument("--member-policy", help=argparse.SUPPRESS)
+    parser.add_argument("--api-latency", type=float, default=0.02, help="simulated seconds per guild.invites() call")
+    parser.add_argument("--join-window", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    return parser.parse_args()
+
+# Fakes: just the attributes and coroutines main.py touches
+
+class FakePermissions:
+    def __init__(self, administrator):
+        self.administrator = administrator
+
+class FakeUser:
+    def __init__(self, user_id, administrator=False):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.avatar = None
+        self.guild_permissions = FakePermissions(administrator)
+        self.guild = None
+
+class FakeInvite:
+    def __init__(self, code, inviter):
+        self.code = code
+        self.inviter = inviter
+        self.uses = 0
+        self.max_uses = 0
+
+class FakeGuild:
+    def __init__(self, guild_id, users, invites, api_latency):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.icon = None
+        self.users = [FakeUser(guild_id * 100000 + i) for i in range(users)]
+        self.admin = FakeUser(guild_id * 100000 + users, administrator=True)
+        self.invite_list = [FakeInvite(f"g{guild_id}i{i}", self.users[i % len(self.users)]) for i in range(invites)]
+        self.api_latency = api_latency
+        self.invite_calls = 0
+
+    async def invites(self):
+        self.invite_calls += 1
+        await asyncio.sleep(self.api_latency)
+        # A snapshot, like the objects the API returns
+        copies = []
+        for invite in self.invite_list:
+            copy = FakeInvite(invite.code, invite.inviter)
+            copy.uses = invite.uses
+            copies.append(copy)
+        return copies
+
+class FakeResponse:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, content=None, *, embed=None, ephemeral=False, view=None):
+        self.sent.append(embed.to_dict() if embed is not None else content)
+
+    async def edit_message(self, *, embed=None, view=None):
+        self.sent.append(embed.to_dict() if embed is not None else None)
+
+    async def defer(self, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, guild, user):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.response = FakeResponse()
+        self.extras = {}
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(latencies, elapsed, **extra):
+    result = {
+        "count": len(latencies),
+        "seconds": round(elapsed, 4),
+        "throughput_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+    result.update(extra)
+    return result
+
+async def run_concurrently(calls, concurrency):
+    """Await every call (a zero-argument coroutine function) with at most `concurrency` in flight; returns latencies"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(call):
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(timed(call) for call in calls))
+    return latencies
+
+# Scenarios
+
+async def bench_spins(main, guilds, args, rng):
+    for guild in guilds:
+        prizes = [{"name": f"prize {i}", "weight": rng.randint(1, 20), "stock": None} for i in range(args.prizes)]
+        await main.set_prizes(guild.id, "normal", prizes)
+        await main.set_prizes(guild.id, "vip", prizes[:10])
+        await main.update_setting(guild.id, "daily_spin_limit", 10 ** 9)
+        # Enough invites for every spin to be charged
+        await main.adjust_invites_bulk(guild.id, {user.id: args.spins * 5 for user in guild.users}, "bench")
+
+    calls = []
+    for _ in range(args.spins):
+        guild = rng.choice(guilds)
+        interaction = FakeInteraction(guild, rng.choice(guild.users))
+        spin_type = "vip" if rng.random() < 0.2 else "normal"
+        calls.append(lambda interaction=interaction, spin_type=spin_type: main.perform_spin(interaction, spin_type))
+
+    start = time.perf_counter()
+    latencies = await run_concurrently(calls, args.concurrency)
+    return summarize(latencies, time.perf_counter() - start)
+
+async def bench_spin_limit(main, guilds, args):
+    """Many concurrent clicks by the same users must never spin past the daily limit"""
+    limit = 3
+    guild = guilds[0]
+    # Fresh users, so the spins scenario has not used up their day
+    users = [FakeUser(10 ** 11 + i) for i in range(20)]
+    await main.update_setting(guild.id, "daily_spin_limit", limit)
+    await main.adjust_invites_bulk(guild.id, {user.id: limit * 5 for user in users}, "bench")
+    calls = [
+        lambda user=user: main.perform_spin(FakeInteraction(guild, user), "normal")
+        for user in users for _ in range(limit * 5)
+    ]
+    start = time.perf_counter()
+    latencies = await run_concurrently(calls, len(calls))
+    spun = [await main.get_daily_spins(guild.id, user.id) for user in users]
+    violations = sum(1 for count in spun if count > limit)
+    # Every user clicked and paid for more than the limit, so each must have reached it exactly
+    short = sum(1 for count in spun if count < limit)
+    await main.update_setting(guild.id, "daily_spin_limit", 10 ** 9)
+    return summarize(
+        latencies, time.perf_counter() - start,
+        daily_limit=limit, users=len(users), limit_violations=violations, below_limit=short,
+        passed=not violations and not short,
+    )
+
+def won_spin(interaction):
+    sent = interaction.response.sent
+    return bool(sent) and isinstance(sent[0], dict) and sent[0].get("title") == "🎉 نتيجة الدوران!"
+
+async def bench_spin_consistency(main, guilds, args, rng):
+    """--stress-spins spins fired all at once by fresh users under a limit they never reach: every won
+    spin must show up once in the daily counters, the spin stats and the ledger debits, and nowhere twice"""
+    users = {guild.id: [FakeUser(10 ** 9 + guild.id * 10 ** 4 + i) for i in range(args.stress_users)] for guild in guilds}
+    costs = {}
+    for guild in guilds:
+        await main.update_setting(guild.id, "daily_spin_limit", 10 ** 9)
+        settings = await main.get_settings(guild.id)
+        costs[guild.id] = {spin_type: max(0, settings[f"spin_cost_{spin_type}"]) for spin_type in ("normal", "vip")}
+        await main.adjust_invites_bulk(guild.id, {user.id: args.stress_spins * costs[guild.id]["vip"] for user in users[guild.id]}, "bench")
+    ledger_before = {
+        guild.id: await main.io_worker.run(lambda guild_id=guild.id: sum(1 for _ in main.invite_ledger.entries(guild_id)))
+        for guild in guilds
+    }
+
+    spins = []
+    for _ in range(args.stress_spins):
+        guild = rng.choice(guilds)
+        spins.append((FakeInteraction(guild, rng.choice(users[guild.id])), "vip" if rng.random() < 0.2 else "normal"))
+    start = time.perf_counter()
+    latencies = await run_concurrently(
+        [lambda interaction=interaction, spin_type=spin_type: main.perform_spin(interaction, spin_type) for interaction, spin_type in spins],
+        len(spins)
+    )
+    elapsed = time.perf_counter() - start
+
+    won = {}
+    charged = {}
+    for interaction, spin_type in spins:
+        if won_spin(interaction):
+            key = (interaction.guild.id, interaction.user.id)
+            won[key] = won.get(key, 0) + 1
+            charged[key] = charged.get(key, 0) + costs[interaction.guild.id][spin_type]
+    counted = {}
+    in_stats = {}
+    debited = {}
+    today = main.epoch_day()
+    for guild in guilds:
+        stats = (await main.get_spin_stats(guild.id)).get(today, {}).get("users", {})
+        for user in users[guild.id]:
+            counted[guild.id, user.id] = await main.get_daily_spins(guild.id, user.id)
+            in_stats[guild.id, user.id] = stats.get(str(user.id), 0)
+        entries = await main.io_worker.run(lambda guild_id=guild.id: [entry for entry, _ in main.invite_ledger.entries(guild_id)])
+        for entry in entries[ledger_before[guild.id]:]:
+            if entry["reason"] in ("spin", "refund"):
+                key = (guild.id, entry["user_id"])
+                debited[key] = debited.get(key, 0) - entry["normal"] - entry.get("vip", 0)
+
+    keys = [(guild.id, user.id) for guild in guilds for user in users[guild.id]]
+    mismatches = {
+        "daily_spins": sum(1 for key in keys if counted[key] != won.get(key, 0)),
+        "spin_stats": sum(1 for key in keys if in_stats[key] != won.get(key, 0)),
+        "ledger_debits": sum(1 for key in keys if debited.get(key, 0) != charged.get(key, 0)),
+    }
+    return summarize(
+        latencies, elapsed,
+        won=sum(won.values()),
+        daily_spins_total=sum(counted.values()),
+        spin_stats_total=sum(in_stats.values()),
+        ledger_debited=sum(debited.values()),
+        charged=sum(charged.values()),
+        mismatched_users=mismatches,
+        passed=sum(won.values()) == len(spins) and not any(mismatches.values()),
+    )
+
+async def bench_spin_throttle(main, guilds, clicks=50, users=10):
+    """Users mashing a spin button: clicks past the token bucket are shed before any storage access"""
+    guild = guilds[0]
+    button = main.SpinButton(guild.id, "normal")
+    shed_before = main.spin_limiter.shed
+    latencies = []
+    start = time.perf_counter()
+    for user in [FakeUser(10 ** 10 + i) for i in range(users)]:
+        for _ in range(clicks):
+            call_start = time.perf_counter()
+            await button.callback(FakeInteraction(guild, user))
+            latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start, shed=main.spin_limiter.shed - shed_before, buckets=len(main.spin_limiter.buckets))
+
+async def bench_admin(main, guilds, args, rng):
+    operations = []
+    for i in range(args.admin_ops):
+        guild = rng.choice(guilds)
+        interaction = FakeInteraction(guild, guild.admin)
+        kind = i % 5
+        if kind == 0:
+            operations.append(lambda interaction=interaction, user=rng.choice(guild.users): main.add_invites.callback(interaction, user, 3))
+        elif kind == 1:
+            operations.append(lambda interaction=interaction, user=rng.choice(guild.users): main.remove_invites.callback(interaction, user, 1))
+        elif kind == 2:
+            operations.append(lambda interaction=interaction, n=rng.randrange(args.prizes): main.set_prize.callback(interaction, "normal", f"prize {n}", 5.0, None))
+        elif kind == 3:
+            operations.append(lambda interaction=interaction: main.spin_settings.callback(interaction))
+        else:
+            operations.append(lambda interaction=interaction: main.view_prizes.callback(interaction))
+
+    start = time.perf_counter()
+    latencies = await run_concurrently(operations, args.concurrency)
+    return summarize(latencies, time.perf_counter() - start)
+
+async def bench_embeds(main, guilds, rounds=2000):
+    """The /spin-settings embed built from scratch vs served from the embed cache"""
+    guild = guilds[0]
+    build = lambda: main.spin_settings_embed(guild.id)
+    results = {}
+    for label, call in (("uncached", build), ("cached", lambda: main.cached_embed("spin-settings", guild.id, build))):
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(rounds):
+            call_start = time.perf_counter()
+            (await call()).to_dict()
+            latencies.append(time.perf_counter() - call_start)
+        results[label] = summarize(latencies, time.perf_counter() - start)
+    return results
+
+async def bench_spin_stats(main, guilds, args, rng, rounds=200):
+    """/spin-stats latency, then again after as many spins once more: it reads day buckets, not spins"""
+    guild = guilds[0]
+    results = {}
+    for label in ("before", "after"):
+        if label == "after":
+            calls = [
+                lambda user=rng.choice(guild.users): main.perform_spin(FakeInteraction(guild, user), "normal")
+                for _ in range(args.spins)
+            ]
+            await run_concurrently(calls, args.concurrency)
+        spins = sum(sum(bucket.get("spins", {}).values()) for bucket in (await main.get_spin_stats(guild.id)).values())
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(rounds):
+            call_start = time.perf_counter()
+            await main.spin_stats.callback(FakeInteraction(guild, guild.admin), 7)
+            latencies.append(time.perf_counter() - call_start)
+        results[label] = summarize(latencies, time.perf_counter() - start, spins_recorded=spins)
+    return results
+
+async def run_joins(main, guilds, args, rng, offset):
+    for guild in guilds:
+        async with main.invite_lock(guild.id):
+            await main.cache_guild_invites(guild)
+    before = {(guild.id, user.id): (await main.get_invites(guild.id, user.id))["normal"] for guild in guilds for user in guild.users}
+    calls_before = sum(guild.invite_calls for guild in guilds)
+
+    expected = {}
+    latencies = []
+    start = time.perf_counter()
+    for n in range(args.joins):
+        guild = rng.choice(guilds)
+        invite = rng.choice(guild.invite_list)
+        invite.uses += 1
+        expected[guild.id, invite.inviter.id] = expected.get((guild.id, invite.inviter.id), 0) + 1
+        member = FakeUser(10 ** 12 + offset + n)
+        member.guild = guild
+        call_start = time.perf_counter()
+        await main.on_member_join(member)
+        latencies.append(time.perf_counter() - call_start)
+        if n % 50 == 0:
+            # Let batches close and attribute while joins keep arriving
+            await asyncio.sleep(0)
+    while main._join_tasks:
+        await asyncio.gather(*list(main._join_tasks))
+    elapsed = time.perf_counter() - start
+
+    credited = 0
+    wrong = 0
+    for guild in guilds:
+        for user in guild.users:
+            gained = (await main.get_invites(guild.id, user.id))["normal"] - before[guild.id, user.id]
+            credited += gained
+            wrong += abs(gained - expected.get((guild.id, user.id), 0))
+    return summarize(
+        latencies, elapsed,
+        settle_seconds=round(elapsed, 4),
+        invite_fetches=sum(guild.invite_calls for guild in guilds) - calls_before,
+        credited=credited,
+        misattributed=wrong,
+        accuracy=round(1 - wrong / (2 * args.joins), 4) if args.joins else None,
+    )
+
+async def bench_joins(main, guilds, args, rng):
+    """The same join stream attributed one join per invite fetch (no window, batches of one, as
+    before coalescing) and in coalesced windows of --join-window seconds"""
+    window, batch_max = main.JOIN_WINDOW, main.JOIN_BATCH_MAX
+    main.JOIN_WINDOW, main.JOIN_BATCH_MAX = 0, 1
+    try:
+        per_join = await run_joins(main, guilds, args, rng, 0)
+    finally:
+        main.JOIN_WINDOW, main.JOIN_BATCH_MAX = window, batch_max
+    coalesced = await run_joins(main, guilds, args, rng, args.joins)
+    return {"per_join": per_join, "coalesced": coalesced}
+
+async def bench_bulk_invites(main, args, rng, rounds=5):
+    """/bulk-invites: parse a CSV of --bulk-rows rows and apply it in one write"""
+    text = "user_id,delta\n" + "\n".join(f"{10 ** 16 + i},{rng.randint(-5, 20)}" for i in range(args.bulk_rows))
+    data = text.encode("utf-8")
+    latencies = []
+    start = time.perf_counter()
+    for r in range(rounds):
+        call_start = time.perf_counter()
+        deltas, rejected = main.parse_invite_rows(data)
+        await main.adjust_invites_bulk(10 ** 14 + r, deltas, "bench")
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start, rows=args.bulk_rows, rejected=len(rejected))
+
+# A correct sampler fails the distribution check this often; the draws are seeded, so a given
+# --seed either always passes or always fails
+PRIZE_ALPHA = 0.001
+
+def chi_square_p_value(chi_square, dof):
+    """P(X >= chi_square) for X ~ chi-square(dof), by the Wilson-Hilferty normal approximation
+    (within about 1e-3 of the exact value from a few degrees of freedom up)"""
+    z = ((chi_square / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def bench_prize_distribution(main, args, rng):
+    """Chi-square test of alias-table draws against the configured weights"""
+    prizes = [{"name": f"p{i}", "weight": rng.randint(1, 50), "stock": None} for i in range(args.prizes)]
+    table = main.PrizeTable(prizes)
+    counts = dict.fromkeys((p["name"] for p in prizes), 0)
+    start = time.perf_counter()
+    for _ in range(args.draws):
+        counts[table.sample()["name"]] += 1
+    elapsed = time.perf_counter() - start
+    total_weight = sum(p["weight"] for p in prizes)
+    chi_square = sum(
+        (counts[p["name"]] - args.draws * p["weight"] / total_weight) ** 2 / (args.draws * p["weight"] / total_weight)
+        for p in prizes
+    )
+    dof = len(prizes) - 1
+    p_value = chi_square_p_value(chi_square, dof) if dof else 1.0
+    return {
+        "draws": args.draws,
+        "seconds": round(elapsed, 4),
+        "draws_per_s": round(args.draws / elapsed, 1),
+        "chi_square": round(chi_square, 2),
+        "degrees_of_freedom": dof,
+        "p_value": round(p_value, 4),
+        "alpha": PRIZE_ALPHA,
+        "passed": p_value >= PRIZE_ALPHA,
+    }
+
+async def bench_data_file(main, args, rng, rounds=5):
+    """Flush and reload a store holding --file-guilds x --file-users members"""
+    for g in range(args.file_guilds):
+        guild_id = 10 ** 15 + g
+        for u in range(args.file_users):
+            await main.adjust_invites(guild_id, u, rng.randint(1, 100), "bench")
+            if u % 3 == 0:
+                await main.increment_daily_spins(guild_id, u)
+    await main.flush_storage()
+
+    flushes = []
+    for r in range(rounds):
+        for part in main.store.parts():
+            if hasattr(part, "data"):
+                part.dirty.update(part.data)
+        start = time.perf_counter()
+        await main.flush_storage()
+        flushes.append(time.perf_counter() - start)
+
+    # What a flush holds the event loop for when a single guild changed: only its snapshot()
+    # runs on the loop, the rest of the flush waits on the I/O thread
+    on_loop = []
+    for r in range(rounds):
+        await main.adjust_invites(10 ** 15 + r % args.file_guilds, 0, 1, "bench")
+        start = time.perf_counter()
+        for part in main.store.parts():
+            for flushed, path, payload in part.snapshot():
+                part.dirty.update(flushed)
+        on_loop.append(time.perf_counter() - start)
+        await main.flush_storage()
+
+    size = sum(disk_size(part.path) for part in main.store.parts())
+    loads = []
+    for r in range(rounds):
+        fresh = main.build_store(main.SHARD_IDS, main.SHARD_COUNT)
+        start = time.perf_counter()
+        fresh.load()
+        loads.append(time.perf_counter() - start)
+        fresh.close()
+    return {
+        "guilds": args.file_guilds,
+        "users_per_guild": args.file_users,
+        "bytes": size,
+        "flush": summarize(flushes, sum(flushes)),
+        "one_guild_snapshot_on_loop": summarize(on_loop, sum(on_loop)),
+        "load": summarize(loads, sum(loads)),
+    }
+
+async def bench_ledger(main, guilds):
+    """Every balance must match its ledger after the runs above; rebuilding balances from the
+    snapshot replays only the tail, while an audit replays the whole ledger"""
+    await main.flush_storage()
+    guild_ids = await main.io_worker.run(main.invite_ledger.guilds_on_disk)
+    mismatched = 0
+    entries = 0
+    full = []
+    tail = []
+    for guild_id in guild_ids:
+        start = time.perf_counter()
+        balances, count, snapshot_ok = await main.io_worker.run(main.invite_ledger.audit, guild_id)
+        full.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await main.io_worker.run(main.invite_ledger.balances, guild_id)
+        tail.append(time.perf_counter() - start)
+        entries += count
+        mismatched += len(main.invite_differences(balances, await main._store_call(main.store.invite_balances, guild_id)))
+        mismatched += not snapshot_ok
+    return {
+        "guilds": len(guild_ids),
+        "entries": entries,
+        "mismatched": mismatched,
+        "full_replay": summarize(full, sum(full)),
+        "snapshot_replay": summarize(tail, sum(tail)),
+        "passed": mismatched == 0,
+    }
+
+def disk_size(path):
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def bench_layouts(main, args, rng):
+    """Single bot_data.json vs one file per guild in each available encoding: full save,
+    the save after one guild changed (what a spin costs), load time and size on disk"""
+    encodings = ["json", "compact"] + [name for name in ("orjson", "msgpack") if getattr(main, name) is not None]
+    results = {}
+    for guild_count in args.layout_guilds:
+        data = {}
+        for g in range(guild_count):
+            guild = main.default_guild_data()
+            for u in range(args.layout_users):
+                guild["invites"][str(10 ** 17 + u)] = {"normal": rng.randint(0, 100), "vip": 0}
+                guild["daily_spins"][str(10 ** 17 + u)] = [main.epoch_day(), rng.randint(1, 5)]
+            data[str(10 ** 15 + g)] = guild
+        layouts = [("single_file", lambda path: main.JsonStore(path + ".json"))]
+        layouts += [(f"guild_files_{encoding}", lambda path, encoding=encoding: main.GuildFileStore(path, encoding)) for encoding in encodings]
+        for name, make_store in layouts:
+            path = os.path.join(tempfile.mkdtemp(prefix="layout-"), "data")
+            target = make_store(path)
+            target.load()
+            target.import_guilds(data)
+            start = time.perf_counter()
+            target.flush()
+            full_save = time.perf_counter() - start
+
+            one_guild = []
+            for _ in range(10):
+                guild_id = rng.choice(list(data))
+                target.adjust_invites(guild_id, 1, 1)
+                start = time.perf_counter()
+                target.flush()
+                one_guild.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            make_store(path).load()
+            load = time.perf_counter() - start
+            target_path = target.path
+            results[f"{name}_{guild_count}"] = {
+                "guilds": guild_count,
+                "full_save_s": round(full_save, 4),
+                "one_guild_save_p50_ms": round(percentile(one_guild, 0.5) * 1000, 3),
+                "one_guild_save_p99_ms": round(percentile(one_guild, 0.99) * 1000, 3),
+                "load_s": round(load, 4),
+                "bytes": disk_size(target_path),
+            }
+    return results
+
+def bench_memory(main, args, rng):
+    """Memory held by the guild data (tracemalloc): the nested dicts json.load returns against
+    the GuildState objects the JSON stores keep"""
+    results = {}
+    for guild_count in args.memory_guilds:
+        for layout in ("dicts", "slots"):
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            data = {}
+            for g in range(guild_count):
+                guild = main.default_guild_data()
+                for u in range(args.memory_users):
+                    guild["invites"][str(10 ** 17 + u)] = {"normal": rng.randint(0, 100), "vip": 0}
+                    guild["daily_spins"][str(10 ** 17 + u)] = [main.epoch_day(), rng.randint(1, 5)]
+                data[str(10 ** 15 + g)] = guild if layout == "dicts" else main.GuildState.from_json(guild)
+            built = time.perf_counter() - start
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del data
+            results[f"{layout}_{guild_count}"] = {
+                "guilds": guild_count,
+                "users_per_guild": args.memory_users,
+                "bytes": size,
+                "bytes_per_user": round(size / (guild_count * args.memory_users), 1) if args.memory_users else None,
+                "build_s": round(built, 3),
+            }
+        results[f"slots_{guild_count}"]["vs_dicts"] = round(results[f"slots_{guild_count}"]["bytes"] / results[f"dicts_{guild_count}"]["bytes"], 3)
+    return results
+
+# Member cache fixture: the guild payloads the gateway sends at startup, fed to the bot's own
+# ConnectionState. Each policy runs in a fresh process so its RSS starts from scratch
+MEMBER_POLICIES = {
+    "startup_all": {"BOT_MEMBER_CACHE": "all", "BOT_CHUNK_GUILDS": "startup"},
+    "default": {"BOT_MEMBER_CACHE": "voice", "BOT_CHUNK_GUILDS": "none"},
+    "none": {"BOT_MEMBER_CACHE": "none", "BOT_CHUNK_GUILDS": "none"},
+}
+MEMBER_CHUNK_SIZE = 1000
+
+def user_payload(user_id, bot=False):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None, "bot": bot}
+
+def member_payload(user_id):
+    return {"user": user_payload(user_id), "roles": [], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0}
+
+def guild_payload(guild_id, member_ids, bot_id):
+    """GUILD_CREATE of a guild: the bot and the members in voice (about 1%), not the member list"""
+    voice_channel = str(guild_id + 1)
+    in_voice = member_ids[:max(1, len(member_ids) // 100)]
+    return {
+        "id": str(guild_id),
+        "name": f"guild{guild_id}",
+        "member_count": len(member_ids) + 1,
+        "large": len(member_ids) >= 250,
+        "owner_id": str(bot_id),
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+                   "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [{"id": voice_channel, "type": 2, "name": "voice", "position": 0, "permission_overwrites": [], "bitrate": 64000, "user_limit": 0}],
+        "voice_states": [
+            {"user_id": str(user_id), "channel_id": voice_channel, "session_id": "s", "deaf": False, "mute": False,
+             "self_deaf": False, "self_mute": False, "self_video": False, "suppress": False}
+            for user_id in in_voice
+        ],
+        "members": [member_payload(bot_id)] + [member_payload(user_id) for user_id in in_voice],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "threads": [],
+        "presences": [],
+    }
+
+def max_rss_mb():
+    import resource
+    # KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def run_member_fixture(main, args):
+    """Startup as the configured policy sees it: every GUILD_CREATE and, for guilds the policy chunks,
+    every GUILD_MEMBERS_CHUNK (handled the way discord.py's chunk requests handle them)"""
+    import discord
+    state = main.bot._connection
+    bot_id = 1
+    state.user = discord.ClientUser(state=state, data=user_payload(bot_id, bot=True))
+    sizes = [args.fixture_large_members] * args.fixture_large + [args.fixture_small_members] * args.fixture_small
+    rss_before = max_rss_mb()
+    chunk_requests = 0
+    chunk_payloads = 0
+    start = time.perf_counter()
+    for g, member_count in enumerate(sizes):
+        guild_id = 10 ** 16 + g * 10 ** 7
+        member_ids = [10 ** 17 + g * 10 ** 7 + i for i in range(member_count)]
+        guild = state._add_guild_from_data(guild_payload(guild_id, member_ids, bot_id))
+        if not state._guild_needs_chunking(guild):
+            continue
+        chunk_requests += 1
+        for first in range(0, member_count, MEMBER_CHUNK_SIZE):
+            chunk_payloads += 1
+            chunk = [member_payload(user_id) for user_id in member_ids[first:first + MEMBER_CHUNK_SIZE]]
+            members = [discord.Member(guild=guild, data=data, state=state) for data in chunk]
+            if state.member_cache_flags.joined:
+                for member in members:
+                    guild._add_member(member)
+    ready = time.perf_counter() - start
+    return {
+        "guilds": len(sizes),
+        "members": sum(sizes),
+        "cached_members": sum(len(guild.members) for guild in state.guilds),
+        "chunk_requests": chunk_requests,
+        "chunk_payloads": chunk_payloads,
+        "ready_cpu_s": round(ready, 3),
+        "rss_before_mb": rss_before,
+        "rss_mb": max_rss_mb(),
+    }
+
+def bench_member_cache(args):
+    """Time to ready and RSS of each member cache policy against the fixture; chunk_requests are
+    gateway round trips a real startup waits for on top of ready_cpu_s"""
+    results = {}
+    fixture = [
+        "--fixture-large", str(args.fixture_large), "--fixture-large-members", str(args.fixture_large_members),
+        "--fixture-small", str(args.fixture_small), "--fixture-small-members", str(args.fixture_small_members),
+    ]
+    for name, policy in MEMBER_POLICIES.items():
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--member-policy", name, *fixture],
+            env=dict(os.environ, **policy), capture_output=True, text=True, check=True
+        ).stdout
+        results[name] = json.loads(output)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(main, args):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    await main.load_storage()
+    guilds = [FakeGuild(g + 1, args.users, args.invites, args.api_latency) for g in range(args.guilds)]
+    results = {}
+    results["spins"] = await bench_spins(main, guilds, args, rng)
+    results["spin_limit"] = await bench_spin_limit(main, guilds, args)
+    results["spin_consistency"] = await bench_spin_consistency(main, guilds, args, rng)
+    results["spin_throttle"] = await bench_spin_throttle(main, guilds)
+    results["admin"] = await bench_admin(main, guilds, args, rng)
+    results["embeds"] = await bench_embeds(main, guilds)
+    results["spin_stats"] = await bench_spin_stats(main, guilds, args, rng)
+    results["joins"] = await bench_joins(main, guilds, args, rng)
+    results["bulk_invites"] = await bench_bulk_invites(main, args, rng)
+    results["prize_distribution"] = bench_prize_distribution(main, args, rng)
+    results["data_file"] = await bench_data_file(main, args, rng)
+    results["ledger"] = await bench_ledger(main, guilds)
+    results["storage_layouts"] = bench_layouts(main, args, rng)
+    results["memory"] = bench_memory(main, args, rng)
+    results["member_cache"] = bench_member_cache(args)
+    return results
+
+def main_entry():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="wheelbot-bench-")
+    # main.py reads its configuration at import time
+    os.environ.update({
+        "BOT_STORAGE": args.backend,
+        "BOT_JOIN_WINDOW": str(args.join_window),
+        "BOT_METRICS_PORT": "0",
+        "BOT_DB_FILE": os.path.join(workdir, "bot_data.db"),
+        "BOT_DATA_DIR": os.path.join(workdir, "guild_data"),
+        "BOT_SPIN_LOG_DIR": os.path.join(workdir, "spin_logs"),
+        "BOT_LEDGER_DIR": os.path.join(workdir, "invite_ledger"),
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    if args.member_policy:
+        # Child of bench_member_cache: BOT_MEMBER_CACHE/BOT_CHUNK_GUILDS are already in the environment
+        with contextlib.redirect_stdout(sys.stderr):
+            import main
+            result = run_member_fixture(main, args)
+        print(json.dumps(result))
+        return
+
+    # The bot's own log lines go to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import main
+        started = time.perf_counter()
+        results = asyncio.run(run(main, args))
+        main.close_storage()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "total_seconds": round(time.perf_counter() - started, 3),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    # Scenarios that check correctness report "passed"; any failure fails the run
+    failed = [name for name, result in results.items() if isinstance(result, dict) and result.get("passed") is False]
+    if failed:
+        sys.exit(f"❌ failed: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main_entry()
@@ -1,115 +1,2321 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 from discord.ui import View, Button
+from aiohttp import web
+import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import io
+import hashlib
+import heapq
 import json
 import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field, asdict
 from datetime import datetime, date
 import random
+import signal
+import subprocess
+
+# Optional faster encoders for the per-guild data files (BOT_DATA_ENCODING)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+# Peak RSS for the metrics page (Unix only)
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Bot setup
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 intents.voice_states = True
-bot = commands.Bot(command_prefix="!", intents=intents)
 
-# Data storage
-DATA_FILE = "bot_data.json"
+# Member cache: the bot only uses members that arrive with their event (joins, interaction and
+# message authors), so by default no guild is chunked at startup and only members in voice
+# channels stay cached. BOT_MEMBER_CACHE is "all", "none" or flags from "joined,voice";
+# BOT_CHUNK_GUILDS=startup fetches every member of every guild before on_ready (with "all")
+MEMBER_CACHE = os.getenv("BOT_MEMBER_CACHE", "voice").lower()
+CHUNK_GUILDS = os.getenv("BOT_CHUNK_GUILDS", "none").lower()
+
+def member_cache_flags(spec):
+    if spec == "all":
+        return discord.MemberCacheFlags.all()
+    flags = discord.MemberCacheFlags.none()
+    for name in spec.split(","):
+        name = name.strip()
+        if not name or name == "none":
+            continue
+        if name not in discord.MemberCacheFlags.VALID_FLAGS:
+            valid = ", ".join(["all", "none", *discord.MemberCacheFlags.VALID_FLAGS])
+            print(f"❌ Unknown BOT_MEMBER_CACHE flag {name!r}; use one of: {valid}")
+            exit(1)
+        setattr(flags, name, True)
+    return flags
+
+member_options = {
+    "member_cache_flags": member_cache_flags(MEMBER_CACHE),
+    "chunk_guilds_at_startup": CHUNK_GUILDS == "startup",
+}
+
+STARTED_AT = time.perf_counter()
+
+# Sharding: BOT_SHARD_COUNT > 0 runs AutoShardedBot; BOT_SHARD_IDS limits this process
+# to a subset of the shards (see `python main.py launch`)
+SHARD_COUNT = int(os.getenv("BOT_SHARD_COUNT", "0"))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("BOT_SHARD_IDS", "").split(",") if shard_id.strip()] or None
+
+class InstrumentedTree(app_commands.CommandTree):
+    """Command tree that times every slash command; completions are recorded in on_app_command_completion"""
+    async def interaction_check(self, interaction: discord.Interaction):
+        interaction.extras["started"] = time.perf_counter()
+        return True
+    
+    async def on_error(self, interaction: discord.Interaction, error):
+        if interaction.command is not None:
+            record_command(interaction.command.qualified_name, interaction.guild_id, interaction.extras.get("started"), failed=True)
+        await super().on_error(interaction, error)
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, tree_cls=InstrumentedTree, **member_options)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=InstrumentedTree, **member_options)
+
+# Data storage
+DATA_FILE = "bot_data.json"
+DB_FILE = os.getenv("BOT_DB_FILE", "bot_data.db")
+STORAGE_BACKEND = os.getenv("BOT_STORAGE", "json").lower()
+GUILD_DATA_DIR = os.getenv("BOT_DATA_DIR", "guild_data")
+DATA_ENCODING = os.getenv("BOT_DATA_ENCODING", "json").lower()
+if (DATA_ENCODING == "orjson" and orjson is None) or (DATA_ENCODING == "msgpack" and msgpack is None):
+    print(f"❌ BOT_DATA_ENCODING={DATA_ENCODING} needs the {DATA_ENCODING} package; using compact JSON")
+    DATA_ENCODING = "compact"
+FLUSH_INTERVAL = float(os.getenv("BOT_FLUSH_INTERVAL", "5"))
+SPIN_RESULTS_LIMIT = 100
+SPIN_LOG_DIR = os.getenv("BOT_SPIN_LOG_DIR", "spin_logs")
+SPIN_LOG_MAX_BYTES = int(os.getenv("BOT_SPIN_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+SPIN_STATS_DAYS = int(os.getenv("BOT_SPIN_STATS_DAYS", "30"))
+LEDGER_DIR = os.getenv("BOT_LEDGER_DIR", "invite_ledger")
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("BOT_LEDGER_SNAPSHOT_EVERY", "1000"))
+COMMAND_HASH_FILE = os.getenv("BOT_COMMAND_HASH_FILE", "command_tree.sha256")
+
+DEFAULT_SETTINGS = {
+    "spin_cost_normal": 1,
+    "spin_cost_vip": 5,
+    "bot_avatar_url": None,
+    "streaming_status": "الدوران والفوز!",
+    "invite_log_channel": None,
+    "daily_spin_limit": 10,
+    # Which channels !spin accepts: name patterns for the channel or its category, or explicit category ids
+    "ticket_channel_patterns": ["ticket", "تذكرة"],
+    "ticket_category_patterns": ["ticket", "تذاكر"],
+    "ticket_category_ids": [],
+}
+DEFAULT_PRIZES = {
+    "normal": ["جائزة 1", "جائزة 2", "جائزة 3", "جائزة 4", "جائزة 5"],
+    "vip": ["جائزة VIP 1", "جائزة VIP 2", "جائزة VIP 3", "جائزة VIP 4", "جائزة VIP 5"],
+}
+
+def normalize_prize(prize):
+    """Prizes used to be plain names; they are now {"name", "weight", "stock"} with stock None meaning unlimited"""
+    if isinstance(prize, str):
+        return {"name": prize, "weight": 1, "stock": None}
+    return {"name": prize["name"], "weight": prize.get("weight", 1), "stock": prize.get("stock")}
+
+def take_stock(prizes, name, position=None):
+    """Take one unit of a limited prize from a stored prize list; returns the stock left, or None if it is gone.
+    `position` is where the prize was when its table was built; the list is only searched if it moved since"""
+    if position is None or not 0 <= position < len(prizes) or normalize_prize(prizes[position])["name"] != name:
+        position = next((i for i, prize in enumerate(prizes) if normalize_prize(prize)["name"] == name), None)
+        if position is None:
+            return None
+    prize = normalize_prize(prizes[position])
+    if prize["stock"] is None or prize["stock"] <= 0:
+        return None
+    prize["stock"] -= 1
+    prizes[position] = prize
+    return prize["stock"]
+
+# Daily spin counters are stored per user as [epoch day, count]; a counter from an
+# earlier day simply reads as zero, so nothing is written just to reset it
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def epoch_day(day=None):
+    return (day or date.today()).toordinal() - _EPOCH_ORDINAL
+
+def daily_count(entry, today):
+    if not entry:
+        return 0
+    if isinstance(entry, dict):
+        # Old {"date": "YYYY-MM-DD", "count": n} layout
+        entry = [epoch_day(date.fromisoformat(entry["date"])), entry["count"]]
+    return entry[1] if entry[0] == today else 0
+
+def default_guild_data():
+    return {
+        "invites": {},
+        "normal_prizes": list(DEFAULT_PRIZES["normal"]),
+        "vip_prizes": list(DEFAULT_PRIZES["vip"]),
+        "settings": dict(DEFAULT_SETTINGS),
+        "daily_spins": {},
+        "spin_stats": {}
+    }
+
+# Spin statistics are counters in day buckets: {day: {kind: {key: count}}}, where kind is
+# "spins" (key: spin type), a spin type (key: prize) or "users" (key: user id). Each spin
+# bumps three counters. Days past SPIN_STATS_DAYS are folded into day 0, which keeps only
+# their "spins" totals: prizes and users of older days are dropped, so the stats of a guild
+# (and reading them) stay bounded by the retained buckets
+def spin_stat_keys(spin_type, prize, user_id):
+    return [("spins", spin_type), (spin_type, prize), ("users", str(user_id))]
+
+def fold_stat_bucket(into, bucket):
+    for kind, counts in bucket.items():
+        target = into.setdefault(kind, {})
+        for key, count in counts.items():
+            target[key] = target.get(key, 0) + count
+
+def archive_stat_buckets(stats, before_day):
+    """Fold the "spins" of days older than before_day into day 0 and drop the rest of those days;
+    returns how many days were folded"""
+    old = [day for day in stats if 0 < day < before_day]
+    spins = dict(stats.get(0, {}).get("spins", {}))
+    for day in old:
+        for spin_type, count in stats.pop(day).get("spins", {}).items():
+            spins[spin_type] = spins.get(spin_type, 0) + count
+    # Older versions kept every kind in day 0
+    stats[0] = {"spins": spins}
+    return len(old)
+
+# In memory, the JSON-backed stores keep each guild as slotted objects with integer ids
+# rather than the nested dicts of the file layout, which repeat every key string for every
+# user. Files keep the dict layout: from_json and to_json convert on load and on flush
+@dataclass(slots=True)
+class InviteBalance:
+    normal: int = 0
+    vip: int = 0
+    
+    def to_json(self):
+        return {"normal": self.normal, "vip": self.vip}
+
+@dataclass(slots=True)
+class DailyCounter:
+    day: int
+    count: int
+    
+    @classmethod
+    def from_json(cls, entry):
+        if isinstance(entry, dict):
+            # Old {"date": "YYYY-MM-DD", "count": n} layout
+            return cls(epoch_day(date.fromisoformat(entry["date"])), entry["count"])
+        return cls(entry[0], entry[1])
+    
+    def to_json(self):
+        return [self.day, self.count]
+
+@dataclass(slots=True)
+class Settings:
+    """The fields of DEFAULT_SETTINGS, with the same defaults"""
+    spin_cost_normal: int = DEFAULT_SETTINGS["spin_cost_normal"]
+    spin_cost_vip: int = DEFAULT_SETTINGS["spin_cost_vip"]
+    bot_avatar_url: str | None = None
+    streaming_status: str = DEFAULT_SETTINGS["streaming_status"]
+    invite_log_channel: int | None = None
+    daily_spin_limit: int = DEFAULT_SETTINGS["daily_spin_limit"]
+    ticket_channel_patterns: list = field(default_factory=lambda: list(DEFAULT_SETTINGS["ticket_channel_patterns"]))
+    ticket_category_patterns: list = field(default_factory=lambda: list(DEFAULT_SETTINGS["ticket_category_patterns"]))
+    ticket_category_ids: list = field(default_factory=list)
+    
+    @classmethod
+    def from_json(cls, settings):
+        # Guilds saved before a setting existed get its default; settings that no longer exist are dropped
+        return cls(**{key: value for key, value in settings.items() if key in DEFAULT_SETTINGS})
+    
+    def to_json(self):
+        return asdict(self)
+
+@dataclass(slots=True)
+class GuildState:
+    settings: Settings
+    normal_prizes: list
+    vip_prizes: list
+    invites: dict       # user id -> InviteBalance
+    daily_spins: dict   # user id -> DailyCounter
+    spin_stats: dict    # day -> {kind: {key: count}}
+    extra: dict         # every other key of the blob (set_guild_specific values, legacy spin_results)
+    
+    @classmethod
+    def from_json(cls, guild):
+        guild = dict(guild)
+        return cls(
+            settings=Settings.from_json(guild.pop("settings", {})),
+            normal_prizes=[normalize_prize(p) for p in guild.pop("normal_prizes", DEFAULT_PRIZES["normal"])],
+            vip_prizes=[normalize_prize(p) for p in guild.pop("vip_prizes", DEFAULT_PRIZES["vip"])],
+            invites={
+                int(user_id): InviteBalance(invites.get("normal", 0), invites.get("vip", 0))
+                for user_id, invites in guild.pop("invites", {}).items()
+            },
+            daily_spins={int(user_id): DailyCounter.from_json(entry) for user_id, entry in guild.pop("daily_spins", {}).items() if entry},
+            spin_stats={int(day): bucket for day, bucket in guild.pop("spin_stats", {}).items()},
+            extra=guild,
+        )
+    
+    def to_json(self):
+        """A copy that shares nothing mutable with the guild, so it can be encoded on another thread"""
+        return {
+            "invites": {str(user_id): invites.to_json() for user_id, invites in self.invites.items()},
+            "normal_prizes": list(self.normal_prizes),
+            "vip_prizes": list(self.vip_prizes),
+            "settings": self.settings.to_json(),
+            "daily_spins": {str(user_id): counter.to_json() for user_id, counter in self.daily_spins.items()},
+            "spin_stats": {str(day): {kind: dict(counts) for kind, counts in bucket.items()} for day, bucket in self.spin_stats.items()},
+            **copy.deepcopy(self.extra),
+        }
+    
+    def prizes(self, spin_type):
+        return self.normal_prizes if spin_type == "normal" else self.vip_prizes
+
+def encode_data(data, encoding=DATA_ENCODING):
+    """bytes for a data file: indented JSON, compact JSON, orjson (compact JSON, faster) or msgpack"""
+    if encoding == "msgpack":
+        return msgpack.packb(data)
+    if encoding == "orjson":
+        return orjson.dumps(data)
+    if encoding == "compact":
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+def decode_data(raw):
+    """Reads any encoding encode_data writes: JSON starts with { or [, anything else is msgpack"""
+    if raw.lstrip()[:1] in (b"{", b"["):
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
+    if msgpack is None:
+        raise ValueError("data file is msgpack-encoded but msgpack is not installed")
+    return msgpack.unpackb(raw, strict_map_key=False)
+
+class JsonStore:
+    """All guild data lives in memory as GuildState objects; changed guilds are written back to DATA_FILE in batches"""
+    # Accessors only touch memory, so they run directly on the event loop
+    blocking = False
+    
+    def __init__(self, path=DATA_FILE):
+        self.path = path
+        self.data = None
+        self.dirty = set()
+        # Each guild's entry in the data file, already encoded; only dirty guilds are re-encoded.
+        # snapshot() on the event loop leaves copies of the dirty guilds in `pending` (None for a
+        # removed guild) and write() on the I/O thread encodes them into `fragments`
+        self.fragments = {}
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+    
+    def load(self):
+        if self.data is None:
+            self.data = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = {int(guild_id): GuildState.from_json(guild) for guild_id, guild in json.load(f).items()}
+            self.fragments = {guild_id: self.fragment(guild_id, guild.to_json()) for guild_id, guild in self.data.items()}
+        return self.data
+    
+    def fragment(self, guild_id, doc):
+        """The guild's `"id": {...}` entry, indented to sit inside the top-level object"""
+        body = json.dumps(doc, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        return f'  "{guild_id}": {body}'
+    
+    def snapshot(self):
+        """Take what changed since the last snapshot: a list of (guild_ids, path, payload), one per file to write.
+        Only a copy of each dirty guild is made here; write() encodes them, so it can run on the I/O thread"""
+        if not self.dirty:
+            return []
+        flushed = set(self.dirty)
+        self.dirty.clear()
+        docs = {guild_id: self.data[guild_id].to_json() if guild_id in self.data else None for guild_id in flushed}
+        with self.pending_lock:
+            self.pending.update(docs)
+        # The copies travel through `pending`, not the payload: a queued write replaced by a newer one must not lose them
+        return [(flushed, self.path, None)]
+    
+    def write(self, path, payload=None):
+        """Encode the guilds changed since the last write and join every fragment into the data file; returns the bytes written"""
+        with self.pending_lock:
+            docs, self.pending = self.pending, {}
+        for guild_id, doc in docs.items():
+            if doc is None:
+                self.fragments.pop(guild_id, None)
+            else:
+                self.fragments[guild_id] = self.fragment(guild_id, doc)
+        if not self.fragments:
+            return self.write_file(path, b"{}")
+        return self.write_file(path, ("{\n" + ",\n".join(self.fragments.values()) + "\n}").encode("utf-8"))
+    
+    def write_file(self, path, payload):
+        """Write to a temp file and rename it over the data file so a crash never leaves it half-written"""
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        return len(payload)
+    
+    def flush(self):
+        """Persist every guild changed since the last flush"""
+        total = 0
+        for flushed, path, payload in self.snapshot():
+            try:
+                self.write(path, payload)
+            except Exception:
+                self.dirty.update(flushed)
+                raise
+            total += len(flushed)
+        return total
+    
+    def close(self):
+        self.flush()
+    
+    def parts(self):
+        return [self]
+    
+    def import_guilds(self, guilds):
+        """Import guild blobs in the bot_data.json layout"""
+        states = {int(guild_id): GuildState.from_json(guild) for guild_id, guild in guilds.items()}
+        self.load().update(states)
+        self.dirty.update(states)
+    
+    def mark_dirty(self, guild_id):
+        self.dirty.add(int(guild_id))
+    
+    def guild(self, guild_id):
+        data = self.load()
+        guild_id = int(guild_id)
+        guild = data.get(guild_id)
+        if guild is None:
+            guild = data[guild_id] = GuildState.from_json(default_guild_data())
+            self.mark_dirty(guild_id)
+        return guild
+    
+    def get_settings(self, guild_id):
+        return self.guild(guild_id).settings.to_json()
+    
+    def update_setting(self, guild_id, key, value):
+        setattr(self.guild(guild_id).settings, key, value)
+        self.mark_dirty(guild_id)
+    
+    def get_prizes(self, guild_id, spin_type):
+        return [normalize_prize(p) for p in self.guild(guild_id).prizes(spin_type)]
+    
+    def set_prizes(self, guild_id, spin_type, prizes):
+        setattr(self.guild(guild_id), f"{spin_type}_prizes", [normalize_prize(p) for p in prizes])
+        self.mark_dirty(guild_id)
+    
+    def take_prize_stock(self, guild_id, spin_type, name, position=None):
+        remaining = take_stock(self.guild(guild_id).prizes(spin_type), name, position)
+        if remaining is not None:
+            self.mark_dirty(guild_id)
+        return remaining
+    
+    def get_invites(self, guild_id, user_id):
+        invites = self.guild(guild_id).invites.get(int(user_id))
+        return invites.to_json() if invites is not None else {"normal": 0, "vip": 0}
+    
+    def _balance(self, guild_id, user_id):
+        invites = self.guild(guild_id).invites
+        balance = invites.get(int(user_id))
+        if balance is None:
+            balance = invites[int(user_id)] = InviteBalance()
+        return balance
+    
+    def adjust_invites(self, guild_id, user_id, count, vip=0):
+        invites = self._balance(guild_id, user_id)
+        invites.normal = max(0, invites.normal + count)
+        invites.vip = max(0, invites.vip + vip)
+        self.mark_dirty(guild_id)
+        return invites.to_json()
+    
+    def charge_invites(self, guild_id, user_id, cost):
+        """Take `cost` invites, normal ones first; returns (taken, remaining) or None if the user has fewer"""
+        invites = self.guild(guild_id).invites.get(int(user_id))
+        if invites is None or invites.normal + invites.vip < cost:
+            return None
+        taken = {"normal": min(cost, invites.normal)}
+        taken["vip"] = cost - taken["normal"]
+        invites.normal -= taken["normal"]
+        invites.vip -= taken["vip"]
+        self.mark_dirty(guild_id)
+        return taken, invites.to_json()
+    
+    def adjust_invites_bulk(self, guild_id, deltas):
+        for user_id, count in deltas.items():
+            invites = self._balance(guild_id, user_id)
+            invites.normal = max(0, invites.normal + count)
+        self.mark_dirty(guild_id)
+    
+    def invite_totals(self, guild_id):
+        """{user_id: normal + vip} for every user with invites in the guild"""
+        return {user_id: inv.normal + inv.vip for user_id, inv in self.guild(guild_id).invites.items()}
+    
+    def invite_balances(self, guild_id):
+        """{user_id (str): {"normal", "vip"}} for every user with invites in the guild"""
+        return {str(user_id): inv.to_json() for user_id, inv in self.guild(guild_id).invites.items()}
+    
+    def set_invites(self, guild_id, balances):
+        invites = self.guild(guild_id).invites
+        for user_id, balance in balances.items():
+            invites[int(user_id)] = InviteBalance(balance["normal"], balance["vip"])
+        self.mark_dirty(guild_id)
+    
+    def invite_guilds(self):
+        return [str(guild_id) for guild_id, guild in self.load().items() if guild.invites]
+    
+    def get_daily_spins(self, guild_id, user_id):
+        counter = self.guild(guild_id).daily_spins.get(int(user_id))
+        return counter.count if counter is not None and counter.day == epoch_day() else 0
+    
+    def increment_daily_spins(self, guild_id, user_id):
+        daily_spins = self.guild(guild_id).daily_spins
+        today = epoch_day()
+        counter = daily_spins.get(int(user_id))
+        if counter is None or counter.day != today:
+            counter = daily_spins[int(user_id)] = DailyCounter(today, 0)
+        counter.count += 1
+        self.mark_dirty(guild_id)
+        return counter.count
+    
+    def prune_daily_spins(self):
+        """Drop counters from earlier days; returns how many were removed"""
+        today = epoch_day()
+        removed = 0
+        for guild_id, guild in self.load().items():
+            stale = [user_id for user_id, counter in guild.daily_spins.items() if counter.day != today]
+            for user_id in stale:
+                del guild.daily_spins[user_id]
+            if stale:
+                removed += len(stale)
+                self.mark_dirty(guild_id)
+        return removed
+    
+    def record_spin_stats(self, guild_id, day, keys):
+        bucket = self.guild(guild_id).spin_stats.setdefault(day, {})
+        for kind, key in keys:
+            counts = bucket.setdefault(kind, {})
+            counts[key] = counts.get(key, 0) + 1
+        self.mark_dirty(guild_id)
+    
+    def spin_stats(self, guild_id):
+        return {day: {kind: dict(counts) for kind, counts in bucket.items()} for day, bucket in self.guild(guild_id).spin_stats.items()}
+    
+    def fold_spin_stats(self, before_day):
+        """Fold the day buckets older than before_day into bucket 0 (spin counts only); returns how many were folded"""
+        folded = 0
+        for guild_id, guild in self.load().items():
+            stats = guild.spin_stats
+            if any(0 < day < before_day for day in stats) or set(stats.get(0, {})) - {"spins"}:
+                folded += archive_stat_buckets(stats, before_day)
+                self.mark_dirty(guild_id)
+        return folded
+    
+    def pop_legacy_spin_results(self):
+        """Remove spin history kept in the guild blobs by older versions; returns {guild_id: results}"""
+        legacy = {}
+        for guild_id, guild in self.load().items():
+            results = guild.extra.pop("spin_results", None)
+            if results is not None:
+                self.mark_dirty(guild_id)
+                if results:
+                    legacy[guild_id] = results
+        return legacy
+    
+    def get_guild_specific(self, guild_id, key):
+        return self.guild(guild_id).extra.get(key, {})
+    
+    def set_guild_specific(self, guild_id, key, value):
+        self.guild(guild_id).extra[key] = value
+        self.mark_dirty(guild_id)
+
+class GuildFileStore(JsonStore):
+    """JsonStore with one file per guild under a directory, so a flush rewrites only the guilds
+    that changed. Files are written in DATA_ENCODING and read back in any encoding"""
+    EXTENSIONS = (".json", ".msgpack")
+    
+    def __init__(self, path=GUILD_DATA_DIR, encoding=DATA_ENCODING):
+        super().__init__(path)
+        self.encoding = encoding
+        self.extension = ".msgpack" if encoding == "msgpack" else ".json"
+    
+    def load(self):
+        if self.data is None:
+            self.data = {}
+            if os.path.isdir(self.path):
+                # After a change of encoding a guild may have both files; the newer one wins
+                newest = {}
+                for entry in os.scandir(self.path):
+                    guild_id, extension = os.path.splitext(entry.name)
+                    if extension in self.EXTENSIONS and guild_id.isdigit():
+                        mtime = entry.stat().st_mtime
+                        if guild_id not in newest or mtime > newest[guild_id][0]:
+                            newest[guild_id] = (mtime, entry.path)
+                for guild_id, (_, path) in newest.items():
+                    with open(path, 'rb') as f:
+                        self.data[int(guild_id)] = GuildState.from_json(decode_data(f.read()))
+        return self.data
+    
+    def snapshot(self):
+        if not self.dirty:
+            return []
+        flushed = set(self.dirty)
+        self.dirty.clear()
+        # Copies only; write() encodes them on the I/O thread
+        return [
+            ({guild_id}, os.path.join(self.path, f"{guild_id}{self.extension}"), self.data[guild_id].to_json())
+            for guild_id in flushed if guild_id in self.data
+        ]
+    
+    def write(self, path, doc):
+        os.makedirs(self.path, exist_ok=True)
+        written = self.write_file(path, encode_data(doc, self.encoding))
+        # Drop the guild's file in the previous encoding, if any
+        stem = os.path.splitext(path)[0]
+        for extension in self.EXTENSIONS:
+            if extension != self.extension and os.path.exists(stem + extension):
+                os.remove(stem + extension)
+        return written
+
+class SqliteStore:
+    """Normalized SQLite storage in WAL mode; each accessor only touches the rows it needs"""
+    # Every accessor hits the disk, so they all run on the I/O thread
+    blocking = True
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            guild_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (guild_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS invites (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            normal INTEGER NOT NULL DEFAULT 0,
+            vip INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS daily_spins (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS spin_stats (
+            guild_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, day, kind, key)
+        );
+        CREATE TABLE IF NOT EXISTS prize_stock (
+            guild_id INTEGER NOT NULL,
+            spin_type TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            stock INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, spin_type, position)
+        );
+    """
+    
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self.conn = None
+    
+    def load(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            has_stock = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'prize_stock'").fetchone()
+            self.conn.executescript(self.SCHEMA)
+            if not has_stock:
+                # Stock used to live only in the prize lists; give every limited prize its row
+                for guild_id, key, value in self.conn.execute(
+                    "SELECT guild_id, key, value FROM settings WHERE key IN ('normal_prizes', 'vip_prizes')"
+                ).fetchall():
+                    self._set_stock(guild_id, key[:-len("_prizes")], [normalize_prize(p) for p in json.loads(value)])
+        return self.conn
+    
+    def snapshot(self):
+        # Every statement commits on its own; nothing is buffered
+        return []
+    
+    def flush(self):
+        return 0
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+    
+    def parts(self):
+        return [self]
+    
+    def _get_value(self, guild_id, key, default):
+        row = self.load().execute(
+            "SELECT value FROM settings WHERE guild_id = ? AND key = ?", (int(guild_id), key)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def _set_value(self, guild_id, key, value):
+        self.load().execute(
+            "INSERT INTO settings (guild_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (guild_id, key) DO UPDATE SET value = excluded.value",
+            (int(guild_id), key, json.dumps(value, ensure_ascii=False))
+        )
+    
+    def get_settings(self, guild_id):
+        settings = dict(DEFAULT_SETTINGS)
+        rows = self.load().execute(
+            "SELECT key, value FROM settings WHERE guild_id = ?", (int(guild_id),)
+        ).fetchall()
+        for key, value in rows:
+            if key in DEFAULT_SETTINGS:
+                settings[key] = json.loads(value)
+        return settings
+    
+    def update_setting(self, guild_id, key, value):
+        self._set_value(guild_id, key, value)
+    
+    def get_prizes(self, guild_id, spin_type):
+        """The prize list, with the stock of limited prizes from their prize_stock rows"""
+        prizes = [normalize_prize(p) for p in self._get_value(guild_id, f"{spin_type}_prizes", DEFAULT_PRIZES[spin_type])]
+        for position, stock in self.load().execute(
+            "SELECT position, stock FROM prize_stock WHERE guild_id = ? AND spin_type = ?", (int(guild_id), spin_type)
+        ):
+            if position < len(prizes):
+                prizes[position]["stock"] = stock
+        return prizes
+    
+    def _set_stock(self, guild_id, spin_type, prizes):
+        self.conn.execute("DELETE FROM prize_stock WHERE guild_id = ? AND spin_type = ?", (int(guild_id), spin_type))
+        self.conn.executemany(
+            "INSERT INTO prize_stock (guild_id, spin_type, position, name, stock) VALUES (?, ?, ?, ?, ?)",
+            [(int(guild_id), spin_type, i, p["name"], p["stock"]) for i, p in enumerate(prizes) if p["stock"] is not None]
+        )
+    
+    def set_prizes(self, guild_id, spin_type, prizes):
+        prizes = [normalize_prize(p) for p in prizes]
+        conn = self.load()
+        # import_guilds calls this inside its own transaction
+        own = not conn.in_transaction
+        if own:
+            conn.execute("BEGIN")
+        try:
+            self._set_value(guild_id, f"{spin_type}_prizes", prizes)
+            self._set_stock(guild_id, spin_type, prizes)
+            if own:
+                conn.execute("COMMIT")
+        except Exception:
+            if own:
+                conn.execute("ROLLBACK")
+            raise
+    
+    def take_prize_stock(self, guild_id, spin_type, name, position=None):
+        """One row update per draw; the prize list itself is never rewritten. The prize is looked up
+        by name only when it is no longer at `position`"""
+        conn = self.load()
+        take = (
+            "UPDATE prize_stock SET stock = stock - 1 "
+            "WHERE guild_id = ? AND spin_type = ? AND position = ? AND name = ? AND stock > 0 RETURNING stock"
+        )
+        if position is not None:
+            row = conn.execute(take, (int(guild_id), spin_type, position, name)).fetchone()
+            if row is not None:
+                return row[0]
+        row = conn.execute(
+            "SELECT position FROM prize_stock WHERE guild_id = ? AND spin_type = ? AND name = ? ORDER BY position LIMIT 1",
+            (int(guild_id), spin_type, name)
+        ).fetchone()
+        if row is None or row[0] == position:
+            return None
+        row = conn.execute(take, (int(guild_id), spin_type, row[0], name)).fetchone()
+        return row[0] if row else None
+    
+    def get_invites(self, guild_id, user_id):
+        row = self.load().execute(
+            "SELECT normal, vip FROM invites WHERE guild_id = ? AND user_id = ?", (int(guild_id), int(user_id))
+        ).fetchone()
+        return {"normal": row[0], "vip": row[1]} if row else {"normal": 0, "vip": 0}
+    
+    def adjust_invites(self, guild_id, user_id, count, vip=0):
+        row = self.load().execute(
+            "INSERT INTO invites (guild_id, user_id, normal, vip) VALUES (?, ?, max(0, ?), max(0, ?)) "
+            "ON CONFLICT (guild_id, user_id) DO UPDATE SET normal = max(0, normal + ?), vip = max(0, vip + ?) "
+            "RETURNING normal, vip",
+            (int(guild_id), int(user_id), count, vip, count, vip)
+        ).fetchone()
+        return {"normal": row[0], "vip": row[1]}
+    
+    def charge_invites(self, guild_id, user_id, cost):
+        # Runs on the single I/O thread, so the read and write cannot interleave with another call
+        invites = self.get_invites(guild_id, user_id)
+        if invites["normal"] + invites["vip"] < cost:
+            return None
+        taken = {"normal": min(cost, invites["normal"])}
+        taken["vip"] = cost - taken["normal"]
+        self.load().execute(
+            "UPDATE invites SET normal = normal - ?, vip = vip - ? WHERE guild_id = ? AND user_id = ?",
+            (taken["normal"], taken["vip"], int(guild_id), int(user_id))
+        )
+        return taken, {"normal": invites["normal"] - taken["normal"], "vip": invites["vip"] - taken["vip"]}
+    
+    def adjust_invites_bulk(self, guild_id, deltas):
+        conn = self.load()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO invites (guild_id, user_id, normal) VALUES (?, ?, max(0, ?)) "
+                "ON CONFLICT (guild_id, user_id) DO UPDATE SET normal = max(0, normal + ?)",
+                [(int(guild_id), int(user_id), count, count) for user_id, count in deltas.items()]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def invite_totals(self, guild_id):
+        rows = self.load().execute(
+            "SELECT user_id, normal + vip FROM invites WHERE guild_id = ?", (int(guild_id),)
+        ).fetchall()
+        return dict(rows)
+    
+    def invite_balances(self, guild_id):
+        rows = self.load().execute(
+            "SELECT user_id, normal, vip FROM invites WHERE guild_id = ?", (int(guild_id),)
+        ).fetchall()
+        return {str(user_id): {"normal": normal, "vip": vip} for user_id, normal, vip in rows}
+    
+    def set_invites(self, guild_id, balances):
+        conn = self.load()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO invites (guild_id, user_id, normal, vip) VALUES (?, ?, ?, ?)",
+                [(int(guild_id), int(user_id), balance["normal"], balance["vip"]) for user_id, balance in balances.items()]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def invite_guilds(self):
+        return [str(guild_id) for guild_id, in self.load().execute("SELECT DISTINCT guild_id FROM invites")]
+    
+    def get_daily_spins(self, guild_id, user_id):
+        row = self.load().execute(
+            "SELECT count FROM daily_spins WHERE guild_id = ? AND user_id = ? AND day = ?",
+            (int(guild_id), int(user_id), epoch_day())
+        ).fetchone()
+        return row[0] if row else 0
+    
+    def increment_daily_spins(self, guild_id, user_id):
+        row = self.load().execute(
+            "INSERT INTO daily_spins (guild_id, user_id, day, count) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT (guild_id, user_id) DO UPDATE SET "
+            "count = CASE WHEN day = excluded.day THEN count + 1 ELSE 1 END, day = excluded.day "
+            "RETURNING count",
+            (int(guild_id), int(user_id), epoch_day())
+        ).fetchone()
+        return row[0]
+    
+    def prune_daily_spins(self):
+        # <> rather than < also clears rows left by the old text date format
+        return self.load().execute("DELETE FROM daily_spins WHERE day <> ?", (epoch_day(),)).rowcount
+    
+    def record_spin_stats(self, guild_id, day, keys):
+        conn = self.load()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO spin_stats (guild_id, day, kind, key, count) VALUES (?, ?, ?, ?, 1) "
+                "ON CONFLICT (guild_id, day, kind, key) DO UPDATE SET count = count + 1",
+                [(int(guild_id), day, kind, key) for kind, key in keys]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def spin_stats(self, guild_id):
+        stats = {}
+        for day, kind, key, count in self.load().execute(
+            "SELECT day, kind, key, count FROM spin_stats WHERE guild_id = ?", (int(guild_id),)
+        ):
+            stats.setdefault(day, {}).setdefault(kind, {})[key] = count
+        return stats
+    
+    def fold_spin_stats(self, before_day):
+        conn = self.load()
+        conn.execute("BEGIN")
+        try:
+            conn.execute(
+                "INSERT INTO spin_stats (guild_id, day, kind, key, count) "
+                "SELECT guild_id, 0, kind, key, SUM(count) FROM spin_stats WHERE day > 0 AND day < ? AND kind = 'spins' GROUP BY guild_id, kind, key "
+                "ON CONFLICT (guild_id, day, kind, key) DO UPDATE SET count = count + excluded.count",
+                (before_day,)
+            )
+            folded = conn.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT guild_id, day FROM spin_stats WHERE day > 0 AND day < ?)", (before_day,)
+            ).fetchone()[0]
+            # Day 0 keeps only spin counts (older versions kept every kind there too)
+            conn.execute("DELETE FROM spin_stats WHERE day < ? AND (day > 0 OR kind <> 'spins')", (before_day,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return folded
+    
+    def pop_legacy_spin_results(self):
+        """Move rows out of the spin_results table used by older versions; returns {guild_id: results}"""
+        conn = self.load()
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'spin_results'").fetchone():
+            return {}
+        legacy = {}
+        for guild_id, user, spin_type, prize, time_ in conn.execute(
+            "SELECT guild_id, user, type, prize, time FROM spin_results ORDER BY id"
+        ):
+            legacy.setdefault(str(guild_id), []).append({"user": user, "type": spin_type, "prize": prize, "time": time_})
+        conn.execute("DROP TABLE spin_results")
+        return legacy
+    
+    def get_guild_specific(self, guild_id, key):
+        return self._get_value(guild_id, key, {})
+    
+    def set_guild_specific(self, guild_id, key, value):
+        self._set_value(guild_id, key, value)
+    
+    def import_guilds(self, guilds):
+        """Import guild blobs in the bot_data.json layout; safe to run again over the same data"""
+        conn = self.load()
+        conn.execute("BEGIN")
+        try:
+            for guild_id, guild in guilds.items():
+                gid = int(guild_id)
+                for key, value in guild.get("settings", {}).items():
+                    self._set_value(gid, key, value)
+                for spin_type in DEFAULT_PRIZES:
+                    if f"{spin_type}_prizes" in guild:
+                        self.set_prizes(gid, spin_type, guild[f"{spin_type}_prizes"])
+                conn.executemany(
+                    "INSERT OR REPLACE INTO invites (guild_id, user_id, normal, vip) VALUES (?, ?, ?, ?)",
+                    [(gid, int(uid), inv.get("normal", 0), inv.get("vip", 0)) for uid, inv in guild.get("invites", {}).items()]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO daily_spins (guild_id, user_id, day, count) VALUES (?, ?, ?, ?)",
+                    [(gid, int(uid), epoch_day(), daily_count(entry, epoch_day())) for uid, entry in guild.get("daily_spins", {}).items()
+                     if daily_count(entry, epoch_day())]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO spin_stats (guild_id, day, kind, key, count) VALUES (?, ?, ?, ?, ?)",
+                    [(gid, int(day), kind, key, count) for day, bucket in guild.get("spin_stats", {}).items()
+                     for kind, counts in bucket.items() for key, count in counts.items()]
+                )
+                # History goes to the spin log, once: a second import must not duplicate it
+                if guild.get("spin_results") and not spin_log.segments_on_disk(gid):
+                    spin_log.append(gid, guild["spin_results"])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+def shard_for(guild_id, shard_count):
+    return (int(guild_id) >> 22) % shard_count
+
+def shard_path(path, shard_id):
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_id}{ext}"
+
+class ShardedStore:
+    """One store per owned shard, each with its own file; every guild is routed to the store of its shard,
+    so processes that own different shards never touch the same file"""
+    def __init__(self, make_store, shard_ids, shard_count):
+        self.shard_count = shard_count
+        self.stores = {shard_id: make_store(shard_id) for shard_id in shard_ids}
+        self.blocking = any(part.blocking for part in self.stores.values())
+    
+    def owns(self, guild_id):
+        return shard_for(guild_id, self.shard_count) in self.stores
+    
+    def for_guild(self, guild_id):
+        shard_id = shard_for(guild_id, self.shard_count)
+        if shard_id not in self.stores:
+            raise KeyError(f"guild {guild_id} belongs to shard {shard_id}, which this process does not own")
+        return self.stores[shard_id]
+    
+    def parts(self):
+        return list(self.stores.values())
+    
+    def load(self):
+        for part in self.parts():
+            part.load()
+    
+    def flush(self):
+        return sum(part.flush() for part in self.parts())
+    
+    def close(self):
+        for part in self.parts():
+            part.close()
+    
+    def import_guilds(self, guilds):
+        by_shard = {}
+        for guild_id, guild in guilds.items():
+            by_shard.setdefault(shard_for(guild_id, self.shard_count), {})[guild_id] = guild
+        for shard_id, shard_guilds in by_shard.items():
+            if shard_id in self.stores:
+                self.stores[shard_id].import_guilds(shard_guilds)
+    
+    def prune_daily_spins(self):
+        return sum(part.prune_daily_spins() for part in self.parts())
+    
+    def fold_spin_stats(self, before_day):
+        return sum(part.fold_spin_stats(before_day) for part in self.parts())
+    
+    def invite_guilds(self):
+        return [guild_id for part in self.parts() for guild_id in part.invite_guilds()]
+    
+    def pop_legacy_spin_results(self):
+        legacy = {}
+        for part in self.parts():
+            legacy.update(part.pop_legacy_spin_results())
+        return legacy
+    
+    def get_settings(self, guild_id):
+        return self.for_guild(guild_id).get_settings(guild_id)
+    
+    def update_setting(self, guild_id, key, value):
+        self.for_guild(guild_id).update_setting(guild_id, key, value)
+    
+    def get_prizes(self, guild_id, spin_type):
+        return self.for_guild(guild_id).get_prizes(guild_id, spin_type)
+    
+    def set_prizes(self, guild_id, spin_type, prizes):
+        self.for_guild(guild_id).set_prizes(guild_id, spin_type, prizes)
+    
+    def take_prize_stock(self, guild_id, spin_type, name, position=None):
+        return self.for_guild(guild_id).take_prize_stock(guild_id, spin_type, name, position)
+    
+    def get_invites(self, guild_id, user_id):
+        return self.for_guild(guild_id).get_invites(guild_id, user_id)
+    
+    def adjust_invites(self, guild_id, user_id, count, vip=0):
+        return self.for_guild(guild_id).adjust_invites(guild_id, user_id, count, vip)
+    
+    def charge_invites(self, guild_id, user_id, cost):
+        return self.for_guild(guild_id).charge_invites(guild_id, user_id, cost)
+    
+    def adjust_invites_bulk(self, guild_id, deltas):
+        self.for_guild(guild_id).adjust_invites_bulk(guild_id, deltas)
+    
+    def invite_totals(self, guild_id):
+        return self.for_guild(guild_id).invite_totals(guild_id)
+    
+    def invite_balances(self, guild_id):
+        return self.for_guild(guild_id).invite_balances(guild_id)
+    
+    def set_invites(self, guild_id, balances):
+        self.for_guild(guild_id).set_invites(guild_id, balances)
+    
+    def get_daily_spins(self, guild_id, user_id):
+        return self.for_guild(guild_id).get_daily_spins(guild_id, user_id)
+    
+    def increment_daily_spins(self, guild_id, user_id):
+        return self.for_guild(guild_id).increment_daily_spins(guild_id, user_id)
+    
+    def record_spin_stats(self, guild_id, day, keys):
+        self.for_guild(guild_id).record_spin_stats(guild_id, day, keys)
+    
+    def spin_stats(self, guild_id):
+        return self.for_guild(guild_id).spin_stats(guild_id)
+    
+    def get_guild_specific(self, guild_id, key):
+        return self.for_guild(guild_id).get_guild_specific(guild_id, key)
+    
+    def set_guild_specific(self, guild_id, key, value):
+        self.for_guild(guild_id).set_guild_specific(guild_id, key, value)
+
+def build_store(shard_ids=None, shard_count=0):
+    """The configured backend; with sharding, one file (or directory) per shard (bot_data.shard3.json, guild_data.shard3, ...)"""
+    if STORAGE_BACKEND == "sqlite":
+        make_store = lambda shard_id: SqliteStore(shard_path(DB_FILE, shard_id))
+    elif STORAGE_BACKEND == "files":
+        make_store = lambda shard_id: GuildFileStore(shard_path(GUILD_DATA_DIR, shard_id))
+    else:
+        make_store = lambda shard_id: JsonStore(shard_path(DATA_FILE, shard_id))
+    if not shard_count:
+        if STORAGE_BACKEND == "sqlite":
+            return SqliteStore()
+        return GuildFileStore() if STORAGE_BACKEND == "files" else JsonStore()
+    return ShardedStore(make_store, shard_ids if shard_ids is not None else range(shard_count), shard_count)
+
+def _reverse_lines(f, end, chunk_size=8192):
+    """Yield (offset, line) for every line of a binary file that ends before `end`, last line first"""
+    position = end
+    buffer = b""
+    while position > 0:
+        size = min(chunk_size, position)
+        position -= size
+        f.seek(position)
+        buffer = f.read(size) + buffer
+        parts = buffer.split(b"\n")
+        offset = position + len(buffer)
+        for part in reversed(parts[1:]):
+            offset -= len(part) + 1
+            if part.strip():
+                yield offset + 1, part
+        buffer = parts[0]
+    if buffer.strip():
+        yield 0, buffer
+
+class SpinLog:
+    """Append-only JSONL history of every spin, one directory per guild, rotated into numbered segments by size"""
+    def __init__(self, root=SPIN_LOG_DIR, max_bytes=SPIN_LOG_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.current = {}
+    
+    def _path(self, guild_id, segment):
+        return os.path.join(self.root, str(guild_id), f"{segment:06d}.jsonl")
+    
+    def segments_on_disk(self, guild_id):
+        """Segment numbers of a guild's log, oldest first"""
+        try:
+            names = os.listdir(os.path.join(self.root, str(guild_id)))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-6]) for name in names if name.endswith(".jsonl") and name[:-6].isdigit())
+    
+    def append(self, guild_id, results):
+        guild_id = str(guild_id)
+        segment = self.current.get(guild_id)
+        if segment is None:
+            segments = self.segments_on_disk(guild_id)
+            segment = segments[-1] if segments else 1
+            os.makedirs(os.path.join(self.root, guild_id), exist_ok=True)
+        path = self._path(guild_id, segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+            segment += 1
+            path = self._path(guild_id, segment)
+        self.current[guild_id] = segment
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results))
+    
+    def read_back(self, guild_id, cursor=None):
+        """Yield (result, cursor) newest first, starting just before cursor=(segment, offset)"""
+        for segment in reversed(self.segments_on_disk(guild_id)):
+            if cursor is not None and segment > cursor[0]:
+                continue
+            with open(self._path(guild_id, segment), 'rb') as f:
+                end = cursor[1] if cursor is not None and segment == cursor[0] else f.seek(0, os.SEEK_END)
+                for offset, line in _reverse_lines(f, end):
+                    yield json.loads(line), (segment, offset)
+    
+    def page(self, guild_id, cursor=None, limit=10, user_id=None, spin_type=None):
+        """Up to `limit` results older than cursor matching the filters, plus the cursor for the next page (or None)"""
+        results = []
+        for result, position in self.read_back(guild_id, cursor):
+            if user_id is not None and result.get("user_id") != user_id:
+                continue
+            if spin_type is not None and result["type"] != spin_type:
+                continue
+            results.append(result)
+            if len(results) == limit:
+                return results, position
+        return results, None
+
+spin_log = SpinLog()
+
+# Invite ledger: every credit and debit of invites, in order. Balances are the ledger folded
+# with apply_ledger_entry (the same clamping at zero as the stores), so the store can be
+# checked against it, or rebuilt from it, at any time
+def ledger_entry(user_id, normal, reason, vip=0, by=None):
+    entry = {"user_id": int(user_id), "normal": normal, "reason": reason, "time": int(time.time())}
+    if vip:
+        entry["vip"] = vip
+    if by is not None:
+        entry["by"] = int(by)
+    return entry
+
+def apply_ledger_entry(balances, entry):
+    invites = balances.setdefault(str(entry["user_id"]), {"normal": 0, "vip": 0})
+    invites["normal"] = max(0, invites["normal"] + entry["normal"])
+    invites["vip"] = max(0, invites["vip"] + entry.get("vip", 0))
+
+def invite_differences(expected, actual):
+    """User ids (str) whose balances differ between two {user_id: {"normal", "vip"}} maps; missing reads as zero"""
+    zero = {"normal": 0, "vip": 0}
+    return sorted(
+        user_id for user_id in set(expected) | set(actual)
+        if (expected.get(user_id, zero)["normal"], expected.get(user_id, zero)["vip"])
+        != (actual.get(user_id, zero)["normal"], actual.get(user_id, zero)["vip"])
+    )
+
+class InviteLedger:
+    """Append-only JSONL ledger of invite changes, one directory per guild. Every `snapshot_every`
+    entries the balances are compacted into snapshot.json together with the ledger offset they
+    cover, so rebuilding a guild's balances only replays the entries after it"""
+    def __init__(self, root=LEDGER_DIR, snapshot_every=LEDGER_SNAPSHOT_EVERY):
+        self.root = root
+        self.snapshot_every = snapshot_every
+        self.seq = {}
+        self.since_snapshot = {}
+    
+    def _path(self, guild_id, name):
+        return os.path.join(self.root, str(guild_id), name)
+    
+    def exists(self, guild_id):
+        return os.path.exists(self._path(guild_id, "ledger.jsonl"))
+    
+    def guilds_on_disk(self):
+        try:
+            return [name for name in os.listdir(self.root) if name.isdigit()]
+        except FileNotFoundError:
+            return []
+    
+    def read_snapshot(self, guild_id):
+        try:
+            with open(self._path(guild_id, "snapshot.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"seq": 0, "offset": 0, "balances": {}}
+    
+    def entries(self, guild_id, offset=0, end=None):
+        """Yield (entry, offset just past it) for every entry from byte `offset` on (up to byte `end`)"""
+        try:
+            f = open(self._path(guild_id, "ledger.jsonl"), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                if end is not None and offset >= end:
+                    return
+                # A last line without its newline is a write torn by a crash; it never happened
+                if not line.endswith(b"\n"):
+                    return
+                offset += len(line)
+                yield json.loads(line), offset
+    
+    def balances(self, guild_id, end=None):
+        """Balances from the last snapshot plus the entries after it (up to byte `end`); returns (balances, seq, offset)"""
+        snapshot = self.read_snapshot(guild_id)
+        balances, seq, offset = snapshot["balances"], snapshot["seq"], snapshot["offset"]
+        for entry, offset in self.entries(guild_id, offset, end):
+            apply_ledger_entry(balances, entry)
+            seq = entry["seq"]
+        return balances, seq, offset
+    
+    def _resume(self, guild_id):
+        os.makedirs(os.path.join(self.root, guild_id), exist_ok=True)
+        snapshot = self.read_snapshot(guild_id)
+        seq, offset, count = snapshot["seq"], snapshot["offset"], 0
+        for entry, offset in self.entries(guild_id, offset):
+            seq = entry["seq"]
+            count += 1
+        path = self._path(guild_id, "ledger.jsonl")
+        if os.path.exists(path) and os.path.getsize(path) > offset:
+            # Cut the torn line so the next entry starts on a line of its own
+            os.truncate(path, offset)
+        self.seq[guild_id] = seq
+        self.since_snapshot[guild_id] = count
+    
+    def append(self, guild_id, entries):
+        """Number and write entries (see ledger_entry), then compact a snapshot if one is due"""
+        guild_id = str(guild_id)
+        if guild_id not in self.seq:
+            self._resume(guild_id)
+        numbered = []
+        for entry in entries:
+            self.seq[guild_id] += 1
+            numbered.append({"seq": self.seq[guild_id], **entry})
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        payload = "".join(encode(entry) + "\n" for entry in numbered).encode("utf-8")
+        with open(self._path(guild_id, "ledger.jsonl"), 'ab') as f:
+            start = f.tell()
+            f.write(payload)
+        self.since_snapshot[guild_id] += len(numbered)
+        if self.since_snapshot[guild_id] >= self.snapshot_every:
+            self.compact(guild_id, written=(numbered, start, start + len(payload)))
+    
+    def compact(self, guild_id, balances=None, written=None):
+        """Write the snapshot: the current balances (or `balances`, rebuilt by an audit) up to the end of the ledger.
+        `written` is (entries, start, end) of an append that is still in hand; only the entries before it are read back"""
+        guild_id = str(guild_id)
+        if written is None:
+            replayed, seq, offset = self.balances(guild_id)
+        else:
+            entries, start, offset = written
+            replayed, seq, _ = self.balances(guild_id, end=start)
+            for entry in entries:
+                apply_ledger_entry(replayed, entry)
+            seq = entries[-1]["seq"]
+        if balances is None:
+            balances = replayed
+        snapshot = {
+            "seq": seq,
+            "offset": offset,
+            "balances": {user_id: invites for user_id, invites in balances.items() if invites["normal"] or invites["vip"]},
+        }
+        path = self._path(guild_id, "snapshot.json")
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot, separators=(",", ":")))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        self.since_snapshot[guild_id] = 0
+    
+    def reconcile(self, guild_id, target, reason):
+        """Append the entries that bring the ledger's balances to `target` ({user_id: {"normal", "vip"}});
+        returns how many were needed"""
+        current = self.balances(guild_id)[0] if self.exists(guild_id) else {}
+        zero = {"normal": 0, "vip": 0}
+        entries = []
+        for user_id in invite_differences(target, current):
+            new, old = target.get(user_id, zero), current.get(user_id, zero)
+            entries.append(ledger_entry(user_id, new["normal"] - old["normal"], reason, vip=new["vip"] - old["vip"]))
+        if entries:
+            self.append(guild_id, entries)
+        return len(entries)
+    
+    def audit(self, guild_id):
+        """Replay the whole ledger from its first entry; returns (balances, entry count, whether the
+        snapshot path gives the same balances)"""
+        balances = {}
+        count = 0
+        for entry, _ in self.entries(guild_id):
+            apply_ledger_entry(balances, entry)
+            count += 1
+        return balances, count, not invite_differences(balances, self.balances(guild_id)[0])
+
+invite_ledger = InviteLedger()
+
+# Blocking storage work runs on one dedicated thread so a slow disk never stalls
+# gateway heartbeats or other interactions
+IO_QUEUE_SIZE = int(os.getenv("BOT_IO_QUEUE_SIZE", "256"))
+
+class IOWorker:
+    """Runs blocking storage calls in submission order on a single background thread"""
+    def __init__(self, max_pending=IO_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {
+            "jobs": 0,
+            "coalesced": 0,
+            "queue_full": 0,
+            "io_seconds": 0.0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="storage-io", daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        """Finish every queued job, then stop the thread"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+    
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                if job[0] is not None:
+                    self.pending.pop(job[0], None)
+                key, fn, args, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self.stats["jobs"] += 1
+                self.stats["io_seconds"] += time.perf_counter() - start
+    
+    def _job(self, fn, args, key):
+        """Returns (job, is_new); a write queued under the same key is replaced by the newer one"""
+        with self.lock:
+            job = self.pending.get(key) if key is not None else None
+            if job is not None:
+                job[1], job[2] = fn, args
+                self.stats["coalesced"] += 1
+                return job, False
+            job = [key, fn, args, concurrent.futures.Future()]
+            if key is not None:
+                self.pending[key] = job
+            return job, True
+    
+    async def run(self, fn, *args, key=None):
+        """Run fn on the I/O thread and await its result without blocking the event loop"""
+        self.start()
+        start = time.perf_counter()
+        job, is_new = self._job(fn, args, key)
+        if is_new:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                # Backpressure: wait for room off the event loop
+                self.stats["queue_full"] += 1
+                await asyncio.to_thread(self.queue.put, job)
+        try:
+            return await asyncio.wrap_future(job[3])
+        finally:
+            waited = time.perf_counter() - start
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+# Metrics: counters, gauges and latency histograms kept in memory and served in the
+# Prometheus text format on METRICS_HOST:METRICS_PORT/metrics (BOT_METRICS_PORT=0 turns it off)
+METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9108"))
+LOOP_LAG_INTERVAL = 0.5
+
+class Metrics:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.kinds = {}
+        self.values = collections.defaultdict(float)
+        self.histograms = {}
+    
+    def inc(self, name, value=1, **labels):
+        self.kinds[name] = "counter"
+        self.values[name, tuple(sorted(labels.items()))] += value
+    
+    def set(self, name, value, kind="gauge", **labels):
+        self.kinds[name] = kind
+        self.values[name, tuple(sorted(labels.items()))] = value
+    
+    def observe(self, name, seconds, **labels):
+        self.kinds[name] = "histogram"
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # One count per bucket and one for +Inf, then the sum and the total count
+            histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 3)
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+    
+    @contextlib.contextmanager
+    def timed(self, operation, **labels):
+        """Time a block as bot_operation_seconds{operation=...}; exceptions count in bot_operation_errors_total"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("bot_operation_errors_total", operation=operation, **labels)
+            raise
+        finally:
+            self.observe("bot_operation_seconds", time.perf_counter() - start, operation=operation, **labels)
+    
+    def render(self):
+        lines = []
+        for name, kind in sorted(self.kinds.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), histogram in self.histograms.items():
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKETS + (float("inf"),), histogram):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-2]}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram[-1]}")
+            else:
+                for (metric, labels), value in self.values.items():
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+
+def record_command(command, guild_id, started, failed=False):
+    metrics.inc("bot_commands_total", command=command, guild=guild_id or "dm")
+    if failed:
+        metrics.inc("bot_command_errors_total", command=command)
+    if started is not None:
+        metrics.observe("bot_command_seconds", time.perf_counter() - started, command=command)
+
+def collect_metrics():
+    """Copy the stats other components keep on their own into the registry, right before a scrape"""
+    for key, value in io_worker.stats.items():
+        if key == "max_wait_seconds":
+            metrics.set(f"bot_io_{key}", value)
+        else:
+            metrics.set(f"bot_io_{key}_total", value, kind="counter")
+    metrics.set("bot_io_queue_depth", io_worker.queue.qsize())
+    for key, value in invite_log.stats.items():
+        metrics.set(f"bot_invite_log_{key}_total", value, kind="counter")
+    metrics.set("bot_invite_log_pending", sum(len(lines) for lines in invite_log.pending.values()))
+    for key, value in join_stats.items():
+        metrics.set(f"bot_join_{key}_total", value, kind="counter")
+    metrics.set("bot_guilds", len(bot.guilds))
+    metrics.set("bot_cached_members", sum(len(guild.members) for guild in bot.guilds))
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        metrics.set("bot_max_rss_bytes", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    metrics.set("bot_spin_throttle_buckets", len(spin_limiter.buckets))
+    metrics.set("bot_gateway_latency_seconds", bot.latency if bot.latency == bot.latency else 0)
+
+async def metrics_handler(request):
+    collect_metrics()
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+async def monitor_loop_lag():
+    """How late the event loop wakes up from a sleep: time other coroutines held it"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL)
+        metrics.observe("bot_event_loop_lag_seconds", lag)
+        metrics.set("bot_event_loop_lag_last_seconds", lag)
+
+store = build_store(SHARD_IDS, SHARD_COUNT)
+io_worker = IOWorker()
+
+async def _store_call(fn, *args):
+    if store.blocking:
+        return await io_worker.run(fn, *args)
+    return fn(*args)
+
+async def load_storage():
+    with metrics.timed("storage_load"):
+        await io_worker.run(store.load)
+    if SHARD_COUNT:
+        print(f"✅ Shards {SHARD_IDS if SHARD_IDS is not None else 'all'} of {SHARD_COUNT}")
+
+async def flush_storage():
+    """Serialize pending changes, then write them on the I/O thread; queued writes of the same file are coalesced"""
+    async def write(part, flushed, path, payload):
+        try:
+            with metrics.timed("storage_flush"):
+                written = await io_worker.run(part.write, path, payload, key=("write", path))
+        except Exception:
+            part.dirty.update(flushed)
+            raise
+        metrics.inc("bot_storage_bytes_written_total", written)
+        return len(flushed)
+    
+    # All files are queued at once (one per guild with GuildFileStore) rather than one round trip each
+    writes = [write(part, *pending) for part in store.parts() for pending in part.snapshot()]
+    return sum(await asyncio.gather(*writes))
+
+def close_storage():
+    """Drain the I/O thread and write anything still pending; called once the event loop has stopped"""
+    io_worker.stop()
+    store.close()
+    stats = io_worker.stats
+    print(
+        f"💾 I/O: {stats['jobs']} job(s), {stats['coalesced']} coalesced, "
+        f"{stats['io_seconds']:.3f}s on disk, {stats['wait_seconds']:.3f}s awaited "
+        f"(max {stats['max_wait_seconds'] * 1000:.1f}ms)"
+    )
+
+async def get_settings(guild_id):
+    return await _store_call(store.get_settings, guild_id)
+
+async def update_setting(guild_id, key, value):
+    await _store_call(store.update_setting, guild_id, key, value)
+    bump_settings_version(guild_id)
+
+async def get_prizes(guild_id, spin_type):
+    return await _store_call(store.get_prizes, guild_id, spin_type)
+
+async def set_prizes(guild_id, spin_type, prizes):
+    await _store_call(store.set_prizes, guild_id, spin_type, prizes)
+    invalidate_prize_table(guild_id, spin_type)
+    bump_settings_version(guild_id)
+
+async def take_prize_stock(guild_id, spin_type, name, position=None):
+    remaining = await _store_call(store.take_prize_stock, guild_id, spin_type, name, position)
+    if remaining is not None:
+        # Stock is shown in /prizes and /spin-settings
+        bump_settings_version(guild_id)
+    return remaining
+
+async def get_invites(guild_id, user_id):
+    return await _store_call(store.get_invites, guild_id, user_id)
+
+async def record_ledger(guild_id, entries):
+    await io_worker.run(invite_ledger.append, guild_id, entries)
+
+async def adjust_invites(guild_id, user_id, count, reason, by=None, vip=0):
+    """Add (or with a negative count, remove) normal invites; never goes below zero. Returns the new normal count.
+    The change reaches the ledger before the store, so a crash in between is repaired at the next start"""
+    await record_ledger(guild_id, [ledger_entry(user_id, count, reason, vip=vip, by=by)])
+    invites = await _store_call(store.adjust_invites, guild_id, user_id, count, vip)
+    leaderboard = _leaderboards.get(str(guild_id))
+    if leaderboard is not None:
+        leaderboard.set(int(user_id), invites["normal"] + invites["vip"])
+    return invites["normal"]
+
+async def adjust_invites_bulk(guild_id, deltas, reason, by=None):
+    """Apply {user_id: count} in one write (one transaction with SQLite)"""
+    await record_ledger(guild_id, [ledger_entry(user_id, count, reason, by=by) for user_id, count in deltas.items()])
+    await _store_call(store.adjust_invites_bulk, guild_id, deltas)
+    # Cheaper to rebuild the ranking on the next view than to move every user in it
+    _leaderboards.pop(str(guild_id), None)
+
+async def charge_invites(guild_id, user_id, cost):
+    """Take `cost` invites (normal first, then VIP) in one store call; returns what was taken, or None if the
+    user has fewer. The split is only known once the store has applied it, so the debit is recorded right after"""
+    charged = await _store_call(store.charge_invites, guild_id, user_id, cost)
+    if charged is None:
+        return None
+    taken, invites = charged
+    await record_ledger(guild_id, [ledger_entry(user_id, -taken["normal"], "spin", vip=-taken["vip"])])
+    leaderboard = _leaderboards.get(str(guild_id))
+    if leaderboard is not None:
+        leaderboard.set(int(user_id), invites["normal"] + invites["vip"])
+    return taken
+
+def recover_invites():
+    """Start a ledger (one "opening" entry per user) for guilds that have invites but no ledger yet, and put
+    back into the store whatever it lost since its last flush. Reads each ledger from its snapshot on;
+    runs on the I/O thread before anything else touches the store. Returns (ledgers opened, users repaired)"""
+    opened = repaired = 0
+    for guild_id in store.invite_guilds():
+        if not invite_ledger.exists(guild_id):
+            invite_ledger.reconcile(guild_id, store.invite_balances(guild_id), "opening")
+            opened += 1
+    for guild_id in invite_ledger.guilds_on_disk():
+        if isinstance(store, ShardedStore) and not store.owns(guild_id):
+            continue
+        balances = invite_ledger.balances(guild_id)[0]
+        lost = invite_differences(balances, store.invite_balances(guild_id))
+        if lost:
+            store.set_invites(guild_id, {user_id: balances.get(user_id, {"normal": 0, "vip": 0}) for user_id in lost})
+            repaired += len(lost)
+    return opened, repaired
+
+class InviteLeaderboard:
+    """Ranking index of one guild's invite totals: users grouped in buckets per total, with the
+    distinct totals and each bucket's user ids kept sorted. Top-K and rank lookups cost
+    O(distinct totals) and a page slices its buckets without sorting them."""
+    def __init__(self, totals):
+        self.totals = {}
+        self.buckets = {}
+        for user_id, total in totals.items():
+            if total > 0:
+                self.totals[user_id] = total
+                self.buckets.setdefault(total, []).append(user_id)
+        for bucket in self.buckets.values():
+            bucket.sort()
+        self.counts = sorted(self.buckets)
+    
+    def __len__(self):
+        return len(self.totals)
+    
+    def set(self, user_id, total):
+        old = self.totals.get(user_id)
+        if old == total:
+            return
+        if old is not None:
+            bucket = self.buckets[old]
+            del bucket[bisect.bisect_left(bucket, user_id)]
+            if not bucket:
+                del self.buckets[old]
+                del self.counts[bisect.bisect_left(self.counts, old)]
+            del self.totals[user_id]
+        if total > 0:
+            self.totals[user_id] = total
+            if total not in self.buckets:
+                self.buckets[total] = []
+                bisect.insort(self.counts, total)
+            bisect.insort(self.buckets[total], user_id)
+    
+    def rank(self, user_id):
+        """1-based rank with ties sharing a rank, or None for users without invites"""
+        total = self.totals.get(user_id)
+        if total is None:
+            return None
+        higher = self.counts[bisect.bisect_right(self.counts, total):]
+        return 1 + sum(len(self.buckets[count]) for count in higher)
+    
+    def page(self, offset, limit):
+        """[(rank, user_id, total)] for the users at positions offset..offset+limit, best first"""
+        entries = []
+        rank = 1
+        for count in reversed(self.counts):
+            bucket = self.buckets[count]
+            if offset >= len(bucket):
+                offset -= len(bucket)
+                rank += len(bucket)
+                continue
+            for user_id in bucket[offset:offset + limit - len(entries)]:
+                entries.append((rank, user_id, count))
+            offset = 0
+            rank += len(bucket)
+            if len(entries) == limit:
+                break
+        return entries
+
+# guild id -> InviteLeaderboard, built from storage on first use and then kept
+# current by adjust_invites
+_leaderboards = {}
+
+async def get_leaderboard(guild_id):
+    guild_id = str(guild_id)
+    leaderboard = _leaderboards.get(guild_id)
+    if leaderboard is None:
+        totals = await _store_call(store.invite_totals, guild_id)
+        leaderboard = _leaderboards.setdefault(guild_id, InviteLeaderboard(totals))
+    return leaderboard
+
+async def get_daily_spins(guild_id, user_id):
+    return await _store_call(store.get_daily_spins, guild_id, user_id)
+
+async def increment_daily_spins(guild_id, user_id):
+    return await _store_call(store.increment_daily_spins, guild_id, user_id)
+
+async def prune_daily_spins():
+    return await _store_call(store.prune_daily_spins)
+
+async def record_spin_stats(guild_id, spin_type, prize, user_id):
+    await _store_call(store.record_spin_stats, guild_id, epoch_day(), spin_stat_keys(spin_type, prize, user_id))
+
+async def get_spin_stats(guild_id):
+    return await _store_call(store.spin_stats, guild_id)
+
+async def fold_spin_stats():
+    return await _store_call(store.fold_spin_stats, epoch_day() - SPIN_STATS_DAYS + 1)
+
+# The newest SPIN_RESULTS_LIMIT results of each guild stay in a ring buffer;
+# everything is streamed to the spin log
+_recent_spins = {}
+
+async def add_spin_result(guild_id, result):
+    guild_id = str(guild_id)
+    # Log first: a ring buffer being filled from the log meanwhile then either
+    # already contains this result or exists by the time it is appended here
+    await io_worker.run(spin_log.append, guild_id, [result])
+    if guild_id in _recent_spins:
+        _recent_spins[guild_id].append(result)
+
+async def get_recent_spin_results(guild_id):
+    """Newest results first, served from the ring buffer (filled from the log tail on first use)"""
+    guild_id = str(guild_id)
+    ring = _recent_spins.get(guild_id)
+    if ring is None:
+        results, _ = await io_worker.run(spin_log.page, guild_id, None, SPIN_RESULTS_LIMIT)
+        ring = _recent_spins.setdefault(guild_id, collections.deque(reversed(results), maxlen=SPIN_RESULTS_LIMIT))
+    return list(reversed(ring))
+
+async def get_spin_results_page(guild_id, cursor=None, limit=10, user_id=None, spin_type=None):
+    return await io_worker.run(spin_log.page, str(guild_id), cursor, limit, user_id, spin_type)
+
+async def migrate_spin_results():
+    """Move spin history kept by older versions into the spin log"""
+    legacy = await _store_call(store.pop_legacy_spin_results)
+    for guild_id, results in legacy.items():
+        await io_worker.run(spin_log.append, guild_id, results)
+    return sum(len(results) for results in legacy.values())
+
+async def get_guild_specific(guild_id, key):
+    return await _store_call(store.get_guild_specific, guild_id, key)
+
+async def set_guild_specific(guild_id, key, value):
+    await _store_call(store.set_guild_specific, guild_id, key, value)
+
+# One lock per guild serializes read-modify-write sequences inside that guild,
+# while different guilds keep running in parallel
+_guild_locks = weakref.WeakValueDictionary()
+
+def guild_lock(guild_id):
+    guild_id = str(guild_id)
+    lock = _guild_locks.get(guild_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _guild_locks[guild_id] = lock
+    return lock
+
+# Prize engine
+class PrizeTable:
+    """Alias-method sampler over the in-stock prizes of one wheel; each draw is O(1) whatever the wheel size.
+    positions[i] is where prizes[i] sits in the stored list, so taking its stock needs no search"""
+    def __init__(self, prizes):
+        self.positions = [i for i, p in enumerate(prizes) if p["weight"] > 0 and (p["stock"] is None or p["stock"] > 0)]
+        self.prizes = [prizes[i] for i in self.positions]
+        count = len(self.prizes)
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+        if not count:
+            return
+        
+        # Vose's alias method: scale weights to an average of 1, then pair every
+        # under-full column with an over-full one that tops it up
+        total = sum(p["weight"] for p in self.prizes)
+        scaled = [p["weight"] * count / total for p in self.prizes]
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Whatever is left is 1.0 up to rounding error
+        for i in small + large:
+            self.prob[i] = 1.0
+    
+    def sample_index(self, rng=random):
+        i = int(rng.random() * len(self.prizes))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+    
+    def sample(self, rng=random):
+        return self.prizes[self.sample_index(rng)]
+
+# (guild id, spin type) -> PrizeTable, rebuilt only when prizes change or a stock runs out
+_prize_tables = {}
+
+# Embed cache: responses that only change when an admin edits settings or prizes are built
+# once per (guild, settings version); every setter above bumps the guild's version.
+# Guild-independent embeds (help, about) use guild None, whose version never moves
+_settings_versions = collections.Counter()
+_embed_cache = {}
+
+def bump_settings_version(guild_id):
+    _settings_versions[str(guild_id)] += 1
+
+async def cached_embed(name, guild_id, build):
+    """The cached embed, or a fresh one from `await build()` when the guild's settings changed since it was built.
+    Cached embeds are shared between responses and must not be modified"""
+    key = (name, str(guild_id))
+    version = _settings_versions[str(guild_id)]
+    cached = _embed_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    embed = await build()
+    # Tagged with the version read before building: a setter running meanwhile forces a rebuild next time
+    _embed_cache[key] = (version, embed)
+    return embed
+
+def invalidate_prize_table(guild_id, spin_type):
+    _prize_tables.pop((str(guild_id), spin_type), None)
+
+async def get_prize_table(guild_id, spin_type):
+    key = (str(guild_id), spin_type)
+    table = _prize_tables.get(key)
+    if table is None:
+        table = PrizeTable(await get_prizes(guild_id, spin_type))
+        _prize_tables[key] = table
+    return table
+
+async def draw_prize(guild_id, spin_type):
+    """Pick a prize by weight and take its stock if limited; returns the prize name or None if the wheel is empty.
+    Call with the guild lock held."""
+    for _ in range(3):
+        table = await get_prize_table(guild_id, spin_type)
+        if not table.prizes:
+            return None
+        i = table.sample_index()
+        prize = table.prizes[i]
+        if prize["stock"] is None:
+            return prize["name"]
+        
+        remaining = await take_prize_stock(guild_id, spin_type, prize["name"], table.positions[i])
+        if remaining is None:
+            # The table was stale (prizes edited meanwhile); rebuild and draw again
+            invalidate_prize_table(guild_id, spin_type)
+            continue
+        prize["stock"] = remaining
+        if remaining == 0:
+            invalidate_prize_table(guild_id, spin_type)
+        return prize["name"]
+    return None
+
+def format_prizes(prizes, numbered=False):
+    """Prize list for an embed field: names with their chance and remaining stock, cut to Discord's 1024 limit"""
+    total = sum(p["weight"] for p in prizes if p["stock"] is None or p["stock"] > 0)
+    lines = []
+    for i, prize in enumerate(prizes):
+        available = prize["stock"] is None or prize["stock"] > 0
+        chance = prize["weight"] * 100 / total if total and available else 0
+        line = f"{prize['name']} ({chance:.1f}%)"
+        if prize["stock"] is not None:
+            line += f" - المتبقي: {prize['stock']}"
+        lines.append(f"• {i+1}. {line}" if numbered else line)
+    
+    text = "\n".join(lines)
+    if len(text) > 1024:
+        shown = text[:1000].rsplit("\n", 1)[0]
+        hidden = len(lines) - shown.count("\n") - 1
+        text = shown + f"\n… (+{hidden} جائزة أخرى)"
+    return text
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_task():
+    try:
+        await flush_storage()
+    except Exception as e:
+        print(f"❌ Error saving data: {e}")
+
+@tasks.loop(minutes=30)
+async def prune_task():
+    try:
+        removed = await prune_daily_spins()
+        if removed:
+            print(f"🧹 Pruned {removed} stale daily spin counter(s)")
+        folded = await fold_spin_stats()
+        if folded:
+            print(f"🧹 Folded {folded} day(s) of spin stats")
+    except Exception as e:
+        print(f"❌ Error pruning daily spins: {e}")
+
+# Ticket channels: per guild, the ids of the channels that count as tickets under the
+# guild's rules. Built on first use, kept current by channel events and dropped when
+# the rules change or the gateway reconnects (events may have been missed)
+_ticket_channels = {}
+_ticket_rules = {}
+
+def ticket_rules(settings):
+    return (
+        tuple(pattern.lower() for pattern in settings["ticket_channel_patterns"]),
+        tuple(pattern.lower() for pattern in settings["ticket_category_patterns"]),
+        frozenset(settings["ticket_category_ids"]),
+    )
+
+def matches_ticket_rules(channel, rules):
+    channel_patterns, category_patterns, category_ids = rules
+    name = channel.name.lower()
+    if any(pattern in name for pattern in channel_patterns):
+        return True
+    category = channel.category
+    if category is None:
+        return False
+    if category.id in category_ids:
+        return True
+    category_name = category.name.lower()
+    return any(pattern in category_name for pattern in category_patterns)
+
+async def get_ticket_channels(guild):
+    channels = _ticket_channels.get(guild.id)
+    if channels is None:
+        rules = ticket_rules(await get_settings(guild.id))
+        channels = {
+            channel.id for channel in guild.channels
+            if not isinstance(channel, discord.CategoryChannel) and matches_ticket_rules(channel, rules)
+        }
+        _ticket_rules[guild.id] = rules
+        _ticket_channels[guild.id] = channels
+    return channels
+
+def invalidate_ticket_channels(guild_id):
+    _ticket_channels.pop(int(guild_id), None)
+    _ticket_rules.pop(int(guild_id), None)
+
+def reclassify_channel(channel):
+    """Update an indexed guild's ticket set after a channel was created, renamed or moved"""
+    channels = _ticket_channels.get(channel.guild.id)
+    if channels is None:
+        return
+    if isinstance(channel, discord.CategoryChannel):
+        for child in channel.channels:
+            reclassify_channel(child)
+    elif matches_ticket_rules(channel, _ticket_rules[channel.guild.id]):
+        channels.add(channel.id)
+    else:
+        channels.discard(channel.id)
+
+async def is_ticket_channel(channel):
+    """Check if a channel is a ticket channel"""
+    if not channel or getattr(channel, "guild", None) is None:
+        return False
+    
+    channels = await get_ticket_channels(channel.guild)
+    if channel.id in channels:
+        return True
+    # Threads are not indexed: they count if their parent channel or their own name does
+    if isinstance(channel, discord.Thread):
+        return channel.parent_id in channels or matches_ticket_rules(channel, _ticket_rules[channel.guild.id])
+    return False
+
+@bot.event
+async def on_guild_channel_create(channel):
+    reclassify_channel(channel)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name or getattr(before, "category_id", None) != getattr(after, "category_id", None):
+        reclassify_channel(after)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    channels = _ticket_channels.get(channel.guild.id)
+    if channels is not None:
+        channels.discard(channel.id)
+
+@bot.event
+async def setup_hook():
+    await load_storage()
+    migrated = await migrate_spin_results()
+    if migrated:
+        print(f"✅ Moved {migrated} spin result(s) into {SPIN_LOG_DIR}")
+    with metrics.timed("ledger_recover"):
+        opened, repaired = await io_worker.run(recover_invites)
+    if opened:
+        print(f"✅ Opened the invite ledger of {opened} guild(s) in {LEDGER_DIR}")
+    if repaired:
+        print(f"✅ Restored {repaired} invite balance(s) from the ledger")
+    print(f"✅ Storage ready ({STORAGE_BACKEND}) after {time.perf_counter() - STARTED_AT:.2f}s")
+    flush_task.start()
+    prune_task.start()
+    bot.loop_lag_task = asyncio.create_task(monitor_loop_lag())
+    try:
+        bot.metrics_runner = await start_metrics_server()
+    except OSError as e:
+        print(f"❌ Error starting metrics server: {e}")
+    bot.add_dynamic_items(SpinButton)
+    bot.add_view(MainHelpView())
+    bot.add_view(BackHelpView())
+    await sync_command_tree()
+
+@bot.listen()
+async def on_app_command_completion(interaction, command):
+    record_command(command.qualified_name, interaction.guild_id, interaction.extras.get("started"))
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+@bot.listen()
+async def on_command_completion(ctx):
+    record_command(ctx.command.qualified_name, ctx.guild.id if ctx.guild else None, getattr(ctx, "started", None))
+
+@bot.listen()
+async def on_command_error(ctx, error):
+    if ctx.command is not None:
+        record_command(ctx.command.qualified_name, ctx.guild.id if ctx.guild else None, getattr(ctx, "started", None), failed=True)
+
+# Command tree sync: setup_hook runs once per process (on_ready also fires on every
+# reconnect), and the global sync is skipped when the registered commands did not change
+def command_tree_hash():
+    """Stable hash of the registered app commands: names, descriptions and parameters"""
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda command: (command.get("type", 1), command["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def sync_command_tree():
+    # Commands are global, so with several processes only the one owning shard 0 syncs
+    if SHARD_IDS is not None and 0 not in SHARD_IDS:
+        return
+    tree_hash = command_tree_hash()
+    try:
+        with open(COMMAND_HASH_FILE, "r") as f:
+            if f.read().strip() == tree_hash:
+                print("✅ Command tree unchanged, skipping sync")
+                return
+    except FileNotFoundError:
+        pass
+    try:
+        synced = await bot.tree.sync()
+    except Exception as e:
+        print(f"❌ Error syncing commands: {e}")
+        return
+    with open(COMMAND_HASH_FILE, "w") as f:
+        f.write(tree_hash)
+    print(f"✅ Synced {len(synced)} command(s)")
+
+# Invite cache: guild id -> {code: (uses, inviter id, max uses)}. It lives in memory,
+# is primed for every guild at startup and kept current by invite events, so a
+# join needs a single guild.invites() call to find which invite was used
+invite_cache = {}
+# guild id -> time.monotonic() of its last prime, so on_ready skips guilds a join already primed
+invite_primed_at = {}
+
+# Joins are attributed in batches: the first join in a guild opens a short window,
+# and every join inside it shares one guild.invites() call and one use-count diff
+JOIN_WINDOW = float(os.getenv("BOT_JOIN_WINDOW", "2"))
+JOIN_BATCH_MAX = int(os.getenv("BOT_JOIN_BATCH_MAX", "200"))
+_pending_joins = {}
+_join_tasks = set()
+join_stats = {
+    "joins": 0,
+    "batches": 0,
+    "invite_fetches": 0,
+    "attributed": 0,
+    "unattributed": 0,
+    "ambiguous_batches": 0,
+}
+
+# Invite log: attribution results are buffered per guild and posted to the guild's
+# invite_log_channel as one combined embed per interval, never one message per join
+INVITE_LOG_INTERVAL = float(os.getenv("BOT_INVITE_LOG_INTERVAL", "5"))
+INVITE_LOG_BATCH = 20
+INVITE_LOG_QUEUE_MAX = int(os.getenv("BOT_INVITE_LOG_QUEUE_MAX", "500"))
+
+class InviteLogQueue:
+    """Per-guild buffers of log lines with one delivery task per guild that has lines waiting.
+    Adding never waits: when a guild's buffer is full, new lines are dropped and counted,
+    and the next message says how many were lost"""
+    # Discord allows about 5 messages per 5s in a channel; stay well below that
+    MIN_GAP = 1.0
+    
+    def __init__(self, send, interval=INVITE_LOG_INTERVAL, batch=INVITE_LOG_BATCH, max_pending=INVITE_LOG_QUEUE_MAX):
+        self.send = send
+        self.interval = interval
+        self.batch = batch
+        self.max_pending = max_pending
+        self.pending = {}
+        self.dropped = collections.Counter()
+        self.wake = {}
+        self.tasks = {}
+        self.stats = {"events": 0, "dropped": 0, "messages": 0, "errors": 0}
+    
+    def add(self, guild_id, line):
+        lines = self.pending.setdefault(guild_id, collections.deque())
+        if len(lines) >= self.max_pending:
+            self.dropped[guild_id] += 1
+            self.stats["dropped"] += 1
+        else:
+            lines.append(line)
+            self.stats["events"] += 1
+        if guild_id not in self.tasks:
+            self.wake[guild_id] = asyncio.Event()
+            self.tasks[guild_id] = asyncio.create_task(self._deliver(guild_id))
+        if len(lines) >= self.batch:
+            self.wake[guild_id].set()
+    
+    async def _deliver(self, guild_id):
+        wake = self.wake[guild_id]
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                lines = self.pending[guild_id]
+                if not lines and not self.dropped[guild_id]:
+                    return
+                batch = [lines.popleft() for _ in range(min(self.batch, len(lines)))]
+                try:
+                    await self.send(guild_id, batch, self.dropped.pop(guild_id, 0))
+                    self.stats["messages"] += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"❌ Error posting invite log for guild {guild_id}: {e}")
+                await asyncio.sleep(self.MIN_GAP)
+                if len(lines) >= self.batch:
+                    wake.set()
+        finally:
+            # Lines added from here on start a new task
+            del self.tasks[guild_id]
+            del self.wake[guild_id]
+            if not self.pending.get(guild_id):
+                self.pending.pop(guild_id, None)
+
+async def send_invite_log(guild_id, lines, dropped):
+    channel_id = (await get_settings(guild_id))["invite_log_channel"]
+    channel = bot.get_channel(channel_id) if channel_id else None
+    if channel is None:
+        return
+    embed = discord.Embed(title="📨 سجل الدعوات", description="\n".join(lines), color=discord.Color.blue(), timestamp=datetime.now())
+    if dropped:
+        embed.set_footer(text=f"⚠️ لم يُسجَّل {dropped} حدث بسبب كثرة الانضمامات")
+    await channel.send(embed=embed)
+
+invite_log = InviteLogQueue(send_invite_log)
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+def invite_lock(guild_id):
+    # Invite bookkeeping has its own lock so slow invite fetches never hold up spins
+    return guild_lock(f"invites:{guild_id}")
 
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _invite_entry(invite):
+    return (invite.uses or 0, invite.inviter.id if invite.inviter else None, invite.max_uses or 0)
 
-def get_guild_data(guild_id):
-    data = load_data()
-    guild_id = str(guild_id)
-    if guild_id not in data:
-        data[guild_id] = {
-            "invites": {},
-            "normal_prizes": ["جائزة 1", "جائزة 2", "جائزة 3", "جائزة 4", "جائزة 5"],
-            "vip_prizes": ["جائزة VIP 1", "جائزة VIP 2", "جائزة VIP 3", "جائزة VIP 4", "جائزة VIP 5"],
-            "settings": {
-                "spin_cost_normal": 1,
-                "spin_cost_vip": 5,
-                "bot_avatar_url": None,
-                "streaming_status": "الدوران والفوز!",
-                "invite_log_channel": None,
-                "daily_spin_limit": 10,
-            },
-            "spin_results": [],
-            "daily_spins": {}
-        }
-        save_data(data)
-    return data
+async def cache_guild_invites(guild):
+    """Fetch a guild's invites and remember their use counts; returns the invites or None without permission"""
+    try:
+        invites = await guild.invites()
+    except discord.HTTPException as e:
+        print(f"❌ Cannot read invites for guild {guild.id}: {e}")
+        invite_cache.pop(guild.id, None)
+        return None
+    invite_cache[guild.id] = {invite.code: _invite_entry(invite) for invite in invites}
+    invite_primed_at[guild.id] = time.monotonic()
+    return invites
 
-def get_daily_spins(guild_id, user_id):
-    data = get_guild_data(guild_id)
-    guild_id = str(guild_id)
-    user_id = str(user_id)
-    
-    if user_id not in data[guild_id]["daily_spins"]:
-        data[guild_id]["daily_spins"][user_id] = {"date": str(date.today()), "count": 0}
-        save_data(data)
-    
-    today = str(date.today())
-    if data[guild_id]["daily_spins"][user_id]["date"] != today:
-        data[guild_id]["daily_spins"][user_id] = {"date": today, "count": 0}
-        save_data(data)
+@bot.event
+async def on_ready():
+    print(f"✅ Bot is ready as {bot.user} after {time.perf_counter() - STARTED_AT:.2f}s")
+    if "bot_ready_seconds" not in metrics.kinds:
+        # Time to the first on_ready; later ones are reconnects
+        metrics.set("bot_ready_seconds", time.perf_counter() - STARTED_AT)
     
-    return data[guild_id]["daily_spins"][user_id]["count"]
+    # Events may have been missed while disconnected, so every guild is re-primed. A guild
+    # whose joins primed it meanwhile is skipped: a second fetch would swallow the uses of
+    # joins still waiting in their window
+    _ticket_channels.clear()
+    started = time.monotonic()
+    for guild in bot.guilds:
+        async with invite_lock(guild.id):
+            if invite_primed_at.get(guild.id, 0) < started:
+                await cache_guild_invites(guild)
+    print(f"✅ Cached invites for {len(invite_cache)} guild(s)")
 
-def increment_daily_spins(guild_id, user_id):
-    data = get_guild_data(guild_id)
-    guild_id = str(guild_id)
-    user_id = str(user_id)
-    
-    today = str(date.today())
-    if user_id not in data[guild_id]["daily_spins"] or data[guild_id]["daily_spins"][user_id]["date"] != today:
-        data[guild_id]["daily_spins"][user_id] = {"date": today, "count": 0}
-    
-    data[guild_id]["daily_spins"][user_id]["count"] += 1
-    save_data(data)
+@bot.event
+async def on_guild_join(guild):
+    async with invite_lock(guild.id):
+        await cache_guild_invites(guild)
 
-def get_guild_specific(guild_id, key):
-    data = get_guild_data(guild_id)
-    guild_id = str(guild_id)
-    return data[guild_id].get(key, {})
+@bot.event
+async def on_guild_remove(guild):
+    invite_cache.pop(guild.id, None)
+    invite_primed_at.pop(guild.id, None)
+    invalidate_ticket_channels(guild.id)
 
-def set_guild_specific(guild_id, key, value):
-    data = get_guild_data(guild_id)
-    guild_id = str(guild_id)
-    data[guild_id][key] = value
-    save_data(data)
+@bot.event
+async def on_invite_create(invite):
+    if invite.guild is not None and invite.guild.id in invite_cache:
+        invite_cache[invite.guild.id][invite.code] = _invite_entry(invite)
 
-def is_ticket_channel(channel):
-    """Check if a channel is a ticket channel"""
-    if not channel:
-        return False
+@bot.event
+async def on_invite_delete(invite):
+    if invite.guild is not None and invite.guild.id in invite_cache:
+        invite_cache[invite.guild.id].pop(invite.code, None)
+
+def attribute_joins(before, invites, joins):
+    """Split `joins` new members across inviters by how much each invite's use count grew.
+    Returns ({inviter_id: members}, unattributed_members)"""
+    deltas = []
+    current = set()
+    for invite in invites:
+        current.add(invite.code)
+        uses, inviter_id, max_uses = before.get(invite.code, (0, None, 0))
+        if (invite.uses or 0) > uses:
+            deltas.append(((invite.uses or 0) - uses, invite.inviter.id if invite.inviter else inviter_id))
     
-    channel_name = channel.name.lower()
-    if "ticket" in channel_name or "تذكرة" in channel_name:
-        return True
+    # A limited invite that hit max uses is deleted by Discord on its last join
+    for code, (uses, inviter_id, max_uses) in before.items():
+        if code not in current and max_uses > uses:
+            deltas.append((max_uses - uses, inviter_id))
     
-    if channel.category and ("ticket" in channel.category.name.lower() or "تذاكر" in channel.category.name.lower()):
-        return True
+    # More uses than joins means some joins were missed or left already; the
+    # largest deltas are the most certain, so they are credited first
+    credits = {}
+    remaining = joins
+    for delta, inviter_id in sorted(deltas, key=lambda d: d[0], reverse=True):
+        if remaining <= 0:
+            break
+        taken = min(delta, remaining)
+        remaining -= taken
+        if inviter_id is not None:
+            credits[inviter_id] = credits.get(inviter_id, 0) + taken
     
-    return False
+    if sum(delta for delta, _ in deltas) != joins:
+        join_stats["ambiguous_batches"] += 1
+    return credits, joins - sum(credits.values())
 
-@bot.event
-async def on_ready():
-    print(f"✅ Bot is ready as {bot.user}")
+async def attribute_join_batch(guild, batch):
+    """Wait out the join window, then attribute every join collected in it with a single invite fetch"""
     try:
-        synced = await bot.tree.sync()
-        print(f"✅ Synced {len(synced)} command(s)")
+        await asyncio.wait_for(batch["full"].wait(), JOIN_WINDOW)
+    except asyncio.TimeoutError:
+        pass
+    
+    try:
+        with metrics.timed("join_attribution"):
+            await _attribute_join_batch(guild, batch)
     except Exception as e:
-        print(f"❌ Error syncing commands: {e}")
+        print(f"Error tracking invite: {e}")
+
+async def _attribute_join_batch(guild, batch):
+    async with invite_lock(guild.id):
+        if _pending_joins.get(guild.id) is batch:
+            del _pending_joins[guild.id]
+        members = batch["members"]
+        if not members:
+            return
+        join_stats["batches"] += 1
+        join_stats["invite_fetches"] += 1
+        
+        # Without earlier use counts (guild not primed yet, or its last fetch failed) every
+        # historical use would look new, so this fetch only primes the cache
+        invites_before = invite_cache.get(guild.id)
+        invites = await cache_guild_invites(guild)
+        
+        # Joins that arrived while the invites were being fetched are already
+        # counted in the fetched uses, so they belong to this batch
+        late = _pending_joins.pop(guild.id, None)
+        if late is not None:
+            members.extend(late["members"])
+            late["members"] = []
+            late["full"].set()
+        
+        if invites is None:
+            join_stats["unattributed"] += len(members)
+            return
+        
+        if invites_before is None:
+            credits, unattributed = {}, len(members)
+        else:
+            credits, unattributed = attribute_joins(invites_before, invites, len(members))
+        totals = {}
+        for inviter_id, count in credits.items():
+            totals[inviter_id] = await adjust_invites(str(guild.id), inviter_id, count, "join")
+        join_stats["attributed"] += len(members) - unattributed
+        join_stats["unattributed"] += unattributed
+    
+    if (await get_settings(guild.id))["invite_log_channel"]:
+        for inviter_id, count in credits.items():
+            invite_log.add(guild.id, f"✅ <@{inviter_id}> دعا {count} عضو (الإجمالي {totals[inviter_id]})")
+        if unattributed:
+            invite_log.add(guild.id, f"❔ {unattributed} عضو بدون دعوة معروفة")
 
 @bot.event
 async def on_member_join(member):
@@ -117,37 +2323,21 @@ async def on_member_join(member):
     if member.bot:
         return
     
-    try:
-        guild_id = str(member.guild.id)
-        data = get_guild_data(guild_id)
-        
-        invites_before = data[guild_id].get("invites_cache", {})
-        invites_after = {}
-        
-        for invite in await member.guild.invites():
-            invites_after[invite.code] = invite.uses
-        
-        inviter_id = None
-        for code, uses in invites_after.items():
-            before_uses = invites_before.get(code, 0)
-            if uses > before_uses:
-                try:
-                    invite_obj = await bot.fetch_invite(code)
-                    if invite_obj.inviter:
-                        inviter_id = str(invite_obj.inviter.id)
-                    break
-                except:
-                    pass
-        
-        if inviter_id:
-            if inviter_id not in data[guild_id]["invites"]:
-                data[guild_id]["invites"][inviter_id] = {"normal": 0, "vip": 0}
-            data[guild_id]["invites"][inviter_id]["normal"] += 1
-        
-        data[guild_id]["invites_cache"] = invites_after
-        save_data(data)
-    except Exception as e:
-        print(f"Error tracking invite: {e}")
+    join_stats["joins"] += 1
+    metrics.inc("bot_member_joins_total", guild=member.guild.id)
+    batch = _pending_joins.get(member.guild.id)
+    if batch is None:
+        batch = {"members": [], "full": asyncio.Event()}
+        _pending_joins[member.guild.id] = batch
+        task = asyncio.create_task(attribute_join_batch(member.guild, batch))
+        _join_tasks.add(task)
+        task.add_done_callback(_join_tasks.discard)
+    
+    batch["members"].append(member.id)
+    if len(batch["members"]) >= JOIN_BATCH_MAX:
+        # Close this batch early; later joins open a new one
+        del _pending_joins[member.guild.id]
+        batch["full"].set()
 
 # Admin Commands
 @bot.tree.command(name="add-invites", description="إضافة دعوات لمستخدم")
@@ -158,19 +2348,12 @@ async def add_invites(interaction: discord.Interaction, user: discord.User, coun
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    user_id = str(user.id)
-    
-    if user_id not in data[guild_id]["invites"]:
-        data[guild_id]["invites"][user_id] = {"normal": 0, "vip": 0}
-    
-    data[guild_id]["invites"][user_id]["normal"] += count
-    save_data(data)
+    total = await adjust_invites(guild_id, user.id, count, "admin", by=interaction.user.id)
     
     embed = discord.Embed(title="✅ تمت إضافة الدعوات", color=discord.Color.green())
     embed.add_field(name="المستخدم", value=f"{user.mention}", inline=False)
     embed.add_field(name="تمت الإضافة", value=f"+{count} دعوات", inline=False)
-    embed.add_field(name="إجمالي الدعوات العادية", value=data[guild_id]["invites"][user_id]["normal"], inline=False)
+    embed.add_field(name="إجمالي الدعوات العادية", value=total, inline=False)
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="remove-invites", description="حذف دعوات من مستخدم")
@@ -181,21 +2364,96 @@ async def remove_invites(interaction: discord.Interaction, user: discord.User, c
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    user_id = str(user.id)
-    
-    if user_id not in data[guild_id]["invites"]:
-        data[guild_id]["invites"][user_id] = {"normal": 0, "vip": 0}
-    
-    data[guild_id]["invites"][user_id]["normal"] = max(0, data[guild_id]["invites"][user_id]["normal"] - count)
-    save_data(data)
+    total = await adjust_invites(guild_id, user.id, -count, "admin", by=interaction.user.id)
     
     embed = discord.Embed(title="✅ تم حذف الدعوات", color=discord.Color.red())
     embed.add_field(name="المستخدم", value=f"{user.mention}", inline=False)
     embed.add_field(name="تم الحذف", value=f"-{count} دعوات", inline=False)
-    embed.add_field(name="الدعوات المتبقية", value=data[guild_id]["invites"][user_id]["normal"], inline=False)
+    embed.add_field(name="الدعوات المتبقية", value=total, inline=False)
     await interaction.response.send_message(embed=embed)
 
+BULK_INVITES_MAX_BYTES = 5 * 1024 * 1024
+
+def parse_invite_rows(data):
+    """Rows of (user_id, delta) from a CSV (user_id,delta; header optional) or JSON file
+    ([{"user_id": .., "delta": ..}], [[user_id, delta]] or {user_id: delta}).
+    Returns ({user_id: summed delta}, [(row number, reason)])"""
+    text = data.decode("utf-8-sig")
+    rows = []
+    if text.lstrip().startswith(("[", "{")):
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            parsed = list(parsed.items())
+        for item in parsed:
+            if isinstance(item, dict):
+                rows.append((item.get("user_id"), item.get("delta")))
+            elif isinstance(item, (list, tuple)) and len(item) == 2:
+                rows.append(tuple(item))
+            else:
+                rows.append((None, None))
+    else:
+        for line in csv.reader(io.StringIO(text)):
+            if not "".join(line).strip():
+                rows.append(None)
+            else:
+                rows.append(tuple(line[:2]) if len(line) >= 2 else (line[0], None))
+        # A first row that does not start with a number is a header
+        if rows and rows[0] is not None and not rows[0][0].strip().strip("<@!>").isdigit():
+            rows[0] = None
+    
+    deltas = {}
+    rejected = []
+    for number, row in enumerate(rows, start=1):
+        if row is None:
+            continue
+        user_id, delta = row
+        try:
+            user_id = int(str(user_id).strip().strip("<@!>"))
+            delta = int(str(delta).strip())
+        except (TypeError, ValueError):
+            rejected.append((number, "صف غير صالح"))
+            continue
+        if user_id <= 0 or user_id >= 1 << 64:
+            rejected.append((number, "معرّف مستخدم غير صالح"))
+        elif abs(delta) > 1_000_000:
+            rejected.append((number, "قيمة غير صالحة"))
+        elif delta:
+            deltas[user_id] = deltas.get(user_id, 0) + delta
+    return deltas, rejected
+
+@bot.tree.command(name="bulk-invites", description="تعديل دعوات عدة مستخدمين من ملف CSV أو JSON")
+@app_commands.describe(file="ملف بصفوف user_id,delta (القيمة السالبة للحذف)")
+async def bulk_invites(interaction: discord.Interaction, file: discord.Attachment):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    if file.size > BULK_INVITES_MAX_BYTES:
+        await interaction.response.send_message("❌ الملف كبير جداً (الحد 5 ميغابايت)", ephemeral=True)
+        return
+    
+    await interaction.response.defer()
+    guild_id = str(interaction.guild.id)
+    try:
+        deltas, rejected = await asyncio.to_thread(parse_invite_rows, await file.read())
+    except (UnicodeDecodeError, ValueError) as e:
+        await interaction.followup.send(f"❌ تعذرت قراءة الملف: {e}")
+        return
+    
+    if deltas:
+        await adjust_invites_bulk(guild_id, deltas, "bulk", by=interaction.user.id)
+    
+    embed = discord.Embed(title="✅ تم تعديل الدعوات", color=discord.Color.green() if not rejected else discord.Color.orange())
+    embed.add_field(name="المستخدمون", value=f"{len(deltas)}", inline=True)
+    embed.add_field(name="تمت الإضافة", value=f"+{sum(d for d in deltas.values() if d > 0)}", inline=True)
+    embed.add_field(name="تم الحذف", value=f"-{-sum(d for d in deltas.values() if d < 0)}", inline=True)
+    if rejected:
+        shown = "\n".join(f"• الصف {number}: {reason}" for number, reason in rejected[:10])
+        if len(rejected) > 10:
+            shown += f"\n… (+{len(rejected) - 10})"
+        embed.add_field(name=f"صفوف مرفوضة ({len(rejected)})", value=shown, inline=False)
+    await interaction.followup.send(embed=embed)
+
 @bot.tree.command(name="set-invite-log", description="تعيين قناة سجل الدعوات")
 @app_commands.describe(channel="القناة")
 async def set_invite_log(interaction: discord.Interaction, channel: discord.TextChannel):
@@ -204,14 +2462,54 @@ async def set_invite_log(interaction: discord.Interaction, channel: discord.Text
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    data[guild_id]["settings"]["invite_log_channel"] = channel.id
-    save_data(data)
+    await update_setting(guild_id, "invite_log_channel", channel.id)
     
     embed = discord.Embed(title="✅ تم تعيين قناة السجل", color=discord.Color.green())
     embed.add_field(name="القناة", value=f"{channel.mention}", inline=False)
     await interaction.response.send_message(embed=embed)
 
+@bot.tree.command(name="invites-audit", description="مطابقة أرصدة الدعوات مع سجل العمليات")
+@app_commands.describe(fix="تصحيح الأرصدة المخزنة لتطابق السجل")
+async def invites_audit(interaction: discord.Interaction, fix: bool = False):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    await interaction.response.defer(ephemeral=True)
+    guild_id = str(interaction.guild.id)
+    # Recomputed from the first entry, not from the snapshot, so a bad snapshot shows up too
+    balances, entries, snapshot_ok = await io_worker.run(invite_ledger.audit, guild_id)
+    stored = await _store_call(store.invite_balances, guild_id)
+    mismatched = invite_differences(balances, stored)
+    if fix:
+        zero = {"normal": 0, "vip": 0}
+        if mismatched:
+            await _store_call(store.set_invites, guild_id, {user_id: balances.get(user_id, zero) for user_id in mismatched})
+            _leaderboards.pop(guild_id, None)
+        if not snapshot_ok:
+            await io_worker.run(invite_ledger.compact, guild_id, balances)
+    
+    ok = not mismatched and snapshot_ok
+    embed = discord.Embed(title="✅ الأرصدة مطابقة للسجل" if ok else "⚠️ الأرصدة غير مطابقة للسجل",
+                          color=discord.Color.green() if ok else discord.Color.orange())
+    embed.add_field(name="عمليات السجل", value=f"{entries}", inline=True)
+    embed.add_field(name="المستخدمون", value=f"{sum(1 for b in balances.values() if b['normal'] or b['vip'])}", inline=True)
+    embed.add_field(name="أرصدة مختلفة", value=f"{len(mismatched)}", inline=True)
+    if mismatched:
+        total = lambda invites: invites["normal"] + invites["vip"] if invites else 0
+        shown = "\n".join(
+            f"• <@{user_id}>: السجل {total(balances.get(user_id))}، المخزن {total(stored.get(user_id))}"
+            for user_id in mismatched[:10]
+        )
+        if len(mismatched) > 10:
+            shown += f"\n… (+{len(mismatched) - 10})"
+        embed.add_field(name="المستخدمون المختلفون", value=shown, inline=False)
+    if not snapshot_ok:
+        embed.add_field(name="اللقطة", value="اللقطة المحفوظة لا تطابق السجل", inline=False)
+    if fix and not ok:
+        embed.add_field(name="🔧 التصحيح", value="تم تصحيح الأرصدة حسب السجل", inline=False)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="set-normal-prizes", description="تعيين الجوائز العادية")
 @app_commands.describe(
     prize1="الجائزة الأولى",
@@ -226,10 +2524,8 @@ async def set_normal_prizes(interaction: discord.Interaction, prize1: str, prize
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
     prizes = [p for p in [prize1, prize2, prize3, prize4, prize5] if p.strip()]
-    data[guild_id]["normal_prizes"] = prizes
-    save_data(data)
+    await set_prizes(guild_id, "normal", prizes)
     
     embed = discord.Embed(title="✅ تم تحديث الجوائز العادية", color=discord.Color.blue())
     embed.add_field(name="الجوائز", value="\n".join(prizes), inline=False)
@@ -249,43 +2545,112 @@ async def set_vip_prizes(interaction: discord.Interaction, prize1: str, prize2:
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
     prizes = [p for p in [prize1, prize2, prize3, prize4, prize5] if p.strip()]
-    data[guild_id]["vip_prizes"] = prizes
-    save_data(data)
+    await set_prizes(guild_id, "vip", prizes)
     
     embed = discord.Embed(title="✅ تم تحديث جوائز VIP", color=discord.Color.gold())
     embed.add_field(name="الجوائز", value="\n".join(prizes), inline=False)
     await interaction.response.send_message(embed=embed)
 
-@bot.tree.command(name="spin-settings", description="عرض إعدادات الدوران")
-async def spin_settings(interaction: discord.Interaction):
+@bot.tree.command(name="set-prize", description="إضافة أو تعديل جائزة مع وزنها والكمية المتاحة")
+@app_commands.describe(
+    spin_type="normal أو vip",
+    name="اسم الجائزة",
+    weight="وزن الجائزة (كلما زاد زادت فرصة الفوز بها)",
+    stock="الكمية المتاحة (اتركه فارغاً لكمية غير محدودة)"
+)
+async def set_prize(interaction: discord.Interaction, spin_type: str, name: str, weight: app_commands.Range[float, 0.0, None] = 1.0, stock: app_commands.Range[int, 0, None] = None):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    spin_type = spin_type.lower()
+    if spin_type not in DEFAULT_PRIZES:
+        await interaction.response.send_message("❌ اختر normal أو vip", ephemeral=True)
+        return
+    
+    guild_id = str(interaction.guild.id)
+    name = name.strip()
+    async with guild_lock(guild_id):
+        prizes = [p for p in await get_prizes(guild_id, spin_type) if p["name"] != name]
+        prizes.append({"name": name, "weight": weight, "stock": stock})
+        await set_prizes(guild_id, spin_type, prizes)
+    
+    embed = discord.Embed(title="✅ تم حفظ الجائزة", color=discord.Color.blue())
+    embed.add_field(name="الجائزة", value=name, inline=True)
+    embed.add_field(name="الوزن", value=f"{weight:g}", inline=True)
+    embed.add_field(name="الكمية", value="غير محدودة" if stock is None else f"{stock}", inline=True)
+    embed.add_field(name="عدد الجوائز", value=f"{len(prizes)}", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="remove-prize", description="حذف جائزة من العجلة")
+@app_commands.describe(spin_type="normal أو vip", name="اسم الجائزة")
+async def remove_prize(interaction: discord.Interaction, spin_type: str, name: str):
     if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
         return
     
+    spin_type = spin_type.lower()
+    if spin_type not in DEFAULT_PRIZES:
+        await interaction.response.send_message("❌ اختر normal أو vip", ephemeral=True)
+        return
+    
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    settings = data[guild_id]["settings"]
+    name = name.strip()
+    async with guild_lock(guild_id):
+        prizes = await get_prizes(guild_id, spin_type)
+        remaining = [p for p in prizes if p["name"] != name]
+        if len(remaining) != len(prizes):
+            await set_prizes(guild_id, spin_type, remaining)
+    
+    if len(remaining) == len(prizes):
+        await interaction.response.send_message("❌ لا توجد جائزة بهذا الاسم", ephemeral=True)
+        return
+    
+    embed = discord.Embed(title="✅ تم حذف الجائزة", color=discord.Color.red())
+    embed.add_field(name="الجائزة", value=name, inline=False)
+    embed.add_field(name="الجوائز المتبقية", value=f"{len(remaining)}", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+async def spin_settings_embed(guild_id):
+    settings = await get_settings(guild_id)
+    normal_prizes = await get_prizes(guild_id, "normal")
+    vip_prizes = await get_prizes(guild_id, "vip")
     
     embed = discord.Embed(title="⚙️ إعدادات الدوران", color=discord.Color.purple())
     
     embed.add_field(name="━━━━━━━━ الجوائز العادية ━━━━━━━━", value="", inline=False)
-    embed.add_field(name="عدد الجوائز", value=f"**{len(data[guild_id]['normal_prizes'])} جوائز**", inline=False)
-    if data[guild_id]['normal_prizes']:
-        prizes_list = "\n".join([f"• {i+1}. {p}" for i, p in enumerate(data[guild_id]['normal_prizes'])])
+    embed.add_field(name="عدد الجوائز", value=f"**{len(normal_prizes)} جوائز**", inline=False)
+    if normal_prizes:
+        prizes_list = format_prizes(normal_prizes, numbered=True)
         embed.add_field(name="الجوائز", value=prizes_list, inline=False)
     
     embed.add_field(name="━━━━━━━━ جوائز VIP ━━━━━━━━", value="", inline=False)
-    embed.add_field(name="عدد الجوائز", value=f"**{len(data[guild_id]['vip_prizes'])} جوائز**", inline=False)
-    if data[guild_id]['vip_prizes']:
-        prizes_list = "\n".join([f"• {i+1}. {p}" for i, p in enumerate(data[guild_id]['vip_prizes'])])
+    embed.add_field(name="عدد الجوائز", value=f"**{len(vip_prizes)} جوائز**", inline=False)
+    if vip_prizes:
+        prizes_list = format_prizes(vip_prizes, numbered=True)
         embed.add_field(name="الجوائز", value=prizes_list, inline=False)
     
     embed.add_field(name="━━━━━━━━ الإعدادات العامة ━━━━━━━━", value="", inline=False)
     embed.add_field(name="الحد اليومي للسحب", value=f"**{settings['daily_spin_limit']}** مرات/يوم", inline=True)
+    embed.add_field(name="تكلفة الدوران", value=f"عادي **{settings['spin_cost_normal']}** / VIP **{settings['spin_cost_vip']}** دعوات", inline=True)
     embed.add_field(name="حالة البث", value=f"_{settings['streaming_status']}_", inline=True)
     
+    embed.add_field(name="━━━━━━━━ قنوات التذاكر ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="اسم القناة يحتوي", value=", ".join(settings["ticket_channel_patterns"]) or "—", inline=True)
+    embed.add_field(name="اسم الكاتيجوري يحتوي", value=", ".join(settings["ticket_category_patterns"]) or "—", inline=True)
+    if settings["ticket_category_ids"]:
+        embed.add_field(name="كاتيجوري محددة", value=" ".join(f"<#{category_id}>" for category_id in settings["ticket_category_ids"]), inline=False)
+    return embed
+
+@bot.tree.command(name="spin-settings", description="عرض إعدادات الدوران")
+async def spin_settings(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    guild_id = str(interaction.guild.id)
+    embed = await cached_embed("spin-settings", guild_id, lambda: spin_settings_embed(guild_id))
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="set-spin-invites", description="تعيين تكلفة الدوران")
@@ -296,44 +2661,150 @@ async def set_spin_invites(interaction: discord.Interaction, spin_type: str, cos
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
     
     if spin_type.lower() == "normal":
-        data[guild_id]["settings"]["spin_cost_normal"] = cost
+        await update_setting(guild_id, "spin_cost_normal", cost)
     elif spin_type.lower() == "vip":
-        data[guild_id]["settings"]["spin_cost_vip"] = cost
+        await update_setting(guild_id, "spin_cost_vip", cost)
     else:
         await interaction.response.send_message("❌ اختر normal أو vip", ephemeral=True)
         return
     
-    save_data(data)
-    
     embed = discord.Embed(title="✅ تم تحديث التكلفة", color=discord.Color.green())
     embed.add_field(name="نوع الدوران", value=spin_type, inline=False)
     embed.add_field(name="التكلفة الجديدة", value=cost, inline=False)
     await interaction.response.send_message(embed=embed)
 
+def spin_results_embed(results, page):
+    embed = discord.Embed(title="📊 نتائج الدورانات الأخيرة", color=discord.Color.blue())
+    for result in results:
+        embed.add_field(
+            name=f"{result['user']} - {result['type']}",
+            value=f"الجائزة: {result['prize']}\nالوقت: {result['time']}",
+            inline=False
+        )
+    embed.set_footer(text=f"صفحة {page + 1}")
+    return embed
+
+class SpinResultsView(View):
+    """Pages through the spin log, newest first; cursors[i] is where page i starts, so each page is read by offset.
+    True means "there is a next page but its cursor has not been read yet"."""
+    def __init__(self, guild_id, user_id, spin_type, next_cursor):
+        super().__init__()
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.spin_type = spin_type
+        self.page = 0
+        self.cursors = [None, next_cursor]
+        self.update_buttons()
+    
+    def update_buttons(self):
+        self.previous_button.disabled = self.page == 0
+        self.next_button.disabled = self.cursors[self.page + 1] is None
+    
+    async def show_page(self, interaction: discord.Interaction, page):
+        if self.cursors[page] is True:
+            # Page 0 came from the ring buffer; read it from the log once to learn where page 1 starts
+            _, self.cursors[page] = await get_spin_results_page(self.guild_id, None, 10, self.user_id, self.spin_type)
+        results, next_cursor = await get_spin_results_page(
+            self.guild_id, self.cursors[page], 10, self.user_id, self.spin_type
+        )
+        if not results:
+            self.cursors[page] = None
+            self.update_buttons()
+            await interaction.response.edit_message(view=self)
+            return
+        self.page = page
+        del self.cursors[page + 1:]
+        self.cursors.append(next_cursor)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=spin_results_embed(results, page), view=self)
+    
+    @discord.ui.button(label="◀ الأحدث", style=discord.ButtonStyle.gray)
+    async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+    
+    @discord.ui.button(label="الأقدم ▶", style=discord.ButtonStyle.gray)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
 @bot.tree.command(name="spin-results", description="عرض نتائج الدورانات الأخيرة")
-async def spin_results(interaction: discord.Interaction):
+@app_commands.describe(user="عرض نتائج مستخدم معين", spin_type="normal أو vip")
+async def spin_results(interaction: discord.Interaction, user: discord.User = None, spin_type: str = None):
     if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
         return
     
+    if spin_type is not None and spin_type.lower() not in DEFAULT_PRIZES:
+        await interaction.response.send_message("❌ اختر normal أو vip", ephemeral=True)
+        return
+    
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
+    user_id = user.id if user else None
+    spin_type = spin_type.lower() if spin_type else None
+    
+    if user_id is None and spin_type is None:
+        # The first page comes from the ring buffer; the log is only read when paging
+        results = (await get_recent_spin_results(guild_id))[:10]
+        next_cursor = True if len(results) == 10 else None
+    else:
+        results, next_cursor = await get_spin_results_page(guild_id, None, 10, user_id, spin_type)
     
-    if not data[guild_id]["spin_results"]:
+    if not results:
         await interaction.response.send_message("❌ لا توجد نتائج دورانات حتى الآن", ephemeral=True)
         return
     
-    embed = discord.Embed(title="📊 نتائج الدورانات الأخيرة", color=discord.Color.blue())
-    for result in data[guild_id]["spin_results"][-10:]:
-        embed.add_field(
-            name=f"{result['user']} - {result['type']}",
-            value=f"الجائزة: {result['prize']}\nالوقت: {result['time']}",
-            inline=False
-        )
-    await interaction.response.send_message(embed=embed)
+    view = SpinResultsView(guild_id, user_id, spin_type, next_cursor)
+    await interaction.response.send_message(embed=spin_results_embed(results, 0), view=view)
+
+SPIN_STATS_TOP = 5
+
+def summarize_spin_stats(stats, since_day):
+    """Fold day buckets into (all-time spin counts, days from since_day on, {day: spins} for those days)"""
+    total, recent, per_day = {"spins": {}}, {}, {}
+    for day, bucket in stats.items():
+        fold_stat_bucket(total, {"spins": bucket.get("spins", {})})
+        if day >= since_day:
+            fold_stat_bucket(recent, bucket)
+            per_day[day] = sum(bucket.get("spins", {}).values())
+    return total, recent, per_day
+
+def top_counts(counts, limit=SPIN_STATS_TOP):
+    return heapq.nlargest(limit, counts.items(), key=lambda item: item[1])
+
+def spin_stats_embed(stats, days):
+    total, recent, per_day = summarize_spin_stats(stats, epoch_day() - days + 1)
+    spins = lambda bucket, spin_type: bucket.get("spins", {}).get(spin_type, 0)
+    
+    embed = discord.Embed(title="📈 إحصائيات الدوران", color=discord.Color.blue(), description=f"آخر {days} يوم")
+    embed.add_field(name="إجمالي الدورانات", value=f"عادي **{spins(total, 'normal')}** / VIP **{spins(total, 'vip')}**", inline=True)
+    embed.add_field(name="خلال الفترة", value=f"عادي **{spins(recent, 'normal')}** / VIP **{spins(recent, 'vip')}**", inline=True)
+    if per_day:
+        lines = [f"• {date.fromordinal(day + _EPOCH_ORDINAL)}: {count}" for day, count in sorted(per_day.items(), reverse=True)]
+        embed.add_field(name="📅 الدورانات اليومية", value="\n".join(lines[:10]) + (f"\n… (+{len(lines) - 10})" if len(lines) > 10 else ""), inline=False)
+    for spin_type, label in (("normal", "العادية"), ("vip", "VIP")):
+        hits = recent.get(spin_type, {})
+        if hits:
+            count = sum(hits.values())
+            lines = [f"• {prize} — {n} ({n * 100 / count:.1f}%)" for prize, n in top_counts(hits)]
+            embed.add_field(name=f"🎁 أكثر الجوائز {label}", value="\n".join(lines), inline=False)
+    users = recent.get("users", {})
+    if users:
+        embed.add_field(name="👥 الأكثر دوراناً", value="\n".join(f"• <@{user_id}> — {n}" for user_id, n in top_counts(users)), inline=False)
+    return embed
+
+@bot.tree.command(name="spin-stats", description="إحصائيات الدوران: الجوائز والأيام والأعضاء الأكثر نشاطاً")
+@app_commands.describe(days="عدد الأيام (الافتراضي 7)")
+async def spin_stats(interaction: discord.Interaction, days: app_commands.Range[int, 1, SPIN_STATS_DAYS] = 7):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    stats = await get_spin_stats(str(interaction.guild.id))
+    if not stats:
+        await interaction.response.send_message("❌ لا توجد نتائج دورانات حتى الآن", ephemeral=True)
+        return
+    await interaction.response.send_message(embed=spin_stats_embed(stats, days))
 
 @bot.tree.command(name="bot-avatar", description="تعيين صورة البوت")
 @app_commands.describe(url="رابط الصورة")
@@ -343,9 +2814,7 @@ async def bot_avatar(interaction: discord.Interaction, url: str):
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    data[guild_id]["settings"]["bot_avatar_url"] = url
-    save_data(data)
+    await update_setting(guild_id, "bot_avatar_url", url)
     
     embed = discord.Embed(title="✅ تم تحديث الصورة", color=discord.Color.green())
     embed.add_field(name="الرابط", value=url, inline=False)
@@ -360,9 +2829,7 @@ async def set_streaming(interaction: discord.Interaction, status: str):
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    data[guild_id]["settings"]["streaming_status"] = status
-    save_data(data)
+    await update_setting(guild_id, "streaming_status", status)
     
     await bot.change_presence(activity=discord.Streaming(name=status, url="https://www.twitch.tv/discord"))
     
@@ -382,22 +2849,124 @@ async def set_daily_limit(interaction: discord.Interaction, limit: int):
         return
     
     guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
-    data[guild_id]["settings"]["daily_spin_limit"] = limit
-    save_data(data)
+    await update_setting(guild_id, "daily_spin_limit", limit)
     
     embed = discord.Embed(title="✅ تم تحديد السحب اليومي", color=discord.Color.green())
     embed.add_field(name="الحد اليومي الجديد", value=f"{limit} مرات", inline=False)
     embed.add_field(name="📝 ملاحظة", value="سيتم إعادة تعيين العداد كل يوم عند منتصف الليل", inline=False)
     await interaction.response.send_message(embed=embed)
 
+def parse_patterns(text):
+    """Comma-separated patterns; "-" means none"""
+    if text.strip() == "-":
+        return []
+    return [pattern.strip().lower() for pattern in text.split(",") if pattern.strip()]
+
+@bot.tree.command(name="set-ticket-patterns", description="تحديد الكلمات التي تُعرف بها قنوات التذاكر")
+@app_commands.describe(
+    channel_patterns="كلمات في اسم القناة مفصولة بفواصل (- لإلغائها)",
+    category_patterns="كلمات في اسم الكاتيجوري مفصولة بفواصل (- لإلغائها)"
+)
+async def set_ticket_patterns(interaction: discord.Interaction, channel_patterns: str, category_patterns: str = None):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    guild_id = str(interaction.guild.id)
+    await update_setting(guild_id, "ticket_channel_patterns", parse_patterns(channel_patterns))
+    if category_patterns is not None:
+        await update_setting(guild_id, "ticket_category_patterns", parse_patterns(category_patterns))
+    invalidate_ticket_channels(guild_id)
+    
+    settings = await get_settings(guild_id)
+    channels = await get_ticket_channels(interaction.guild)
+    embed = discord.Embed(title="✅ تم تحديث قواعد التذاكر", color=discord.Color.green())
+    embed.add_field(name="اسم القناة يحتوي", value=", ".join(settings["ticket_channel_patterns"]) or "—", inline=False)
+    embed.add_field(name="اسم الكاتيجوري يحتوي", value=", ".join(settings["ticket_category_patterns"]) or "—", inline=False)
+    embed.add_field(name="قنوات التذاكر الحالية", value=f"{len(channels)}", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="ticket-category", description="إضافة أو إزالة كاتيجوري كل قنواتها تذاكر")
+@app_commands.describe(category="الكاتيجوري")
+async def ticket_category(interaction: discord.Interaction, category: discord.CategoryChannel):
+    if not interaction.user.guild_permissions or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ أنت تحتاج صلاحيات المسؤول", ephemeral=True)
+        return
+    
+    guild_id = str(interaction.guild.id)
+    category_ids = list((await get_settings(guild_id))["ticket_category_ids"])
+    if category.id in category_ids:
+        category_ids.remove(category.id)
+        title = "✅ تمت إزالة الكاتيجوري من التذاكر"
+    else:
+        category_ids.append(category.id)
+        title = "✅ تمت إضافة الكاتيجوري إلى التذاكر"
+    await update_setting(guild_id, "ticket_category_ids", category_ids)
+    invalidate_ticket_channels(guild_id)
+    
+    channels = await get_ticket_channels(interaction.guild)
+    embed = discord.Embed(title=title, color=discord.Color.green())
+    embed.add_field(name="الكاتيجوري", value=category.mention, inline=False)
+    embed.add_field(name="قنوات التذاكر الحالية", value=f"{len(channels)}", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+LEADERBOARD_PAGE_SIZE = 10
+
+async def leaderboard_embed(guild_id, user_id, page):
+    leaderboard = await get_leaderboard(guild_id)
+    pages = max(1, -(-len(leaderboard) // LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    
+    embed = discord.Embed(title="🏆 ترتيب الدعوات", color=discord.Color.gold())
+    entries = leaderboard.page(page * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE)
+    if entries:
+        medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+        embed.description = "\n".join(
+            f"{medals.get(rank, f'#{rank}')} <@{member_id}> - **{total}** دعوة" for rank, member_id, total in entries
+        )
+    else:
+        embed.description = "لا توجد دعوات حتى الآن"
+    
+    rank = leaderboard.rank(user_id)
+    embed.add_field(name="ترتيبك", value=f"#{rank} من {len(leaderboard)}" if rank else "ليس لديك دعوات بعد", inline=False)
+    embed.set_footer(text=f"صفحة {page + 1} من {pages}")
+    return embed, page, pages
+
+class LeaderboardView(View):
+    def __init__(self, guild_id, page, pages):
+        super().__init__()
+        self.guild_id = guild_id
+        self.page = page
+        self.update_buttons(pages)
+    
+    def update_buttons(self, pages):
+        self.previous_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= pages - 1
+    
+    async def show_page(self, interaction: discord.Interaction, page):
+        embed, self.page, pages = await leaderboard_embed(self.guild_id, interaction.user.id, page)
+        self.update_buttons(pages)
+        await interaction.response.edit_message(embed=embed, view=self)
+    
+    @discord.ui.button(label="◀ السابق", style=discord.ButtonStyle.gray)
+    async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+    
+    @discord.ui.button(label="التالي ▶", style=discord.ButtonStyle.gray)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+@bot.tree.command(name="invites-leaderboard", description="عرض ترتيب الأعضاء حسب عدد الدعوات")
+async def invites_leaderboard(interaction: discord.Interaction):
+    guild_id = str(interaction.guild.id)
+    embed, page, pages = await leaderboard_embed(guild_id, interaction.user.id, 0)
+    await interaction.response.send_message(embed=embed, view=LeaderboardView(guild_id, page, pages))
+
 # User Commands
 @bot.command(name="invites", description="عرض عدد دعواتك")
 async def check_invites(ctx):
     guild_id = str(ctx.guild.id)
-    data = get_guild_data(guild_id)
-    user_id = str(ctx.author.id)
-    invites = data[guild_id]["invites"].get(user_id, {"normal": 0, "vip": 0})
+    invites = await get_invites(guild_id, ctx.author.id)
     
     total_invites = invites["normal"] + invites["vip"]
     
@@ -406,92 +2975,156 @@ async def check_invites(ctx):
     embed.set_thumbnail(url=ctx.author.avatar.url if ctx.author.avatar else None)
     await ctx.send(embed=embed)
 
-class SpinView(View):
-    def __init__(self, ctx):
-        super().__init__()
-        self.ctx = ctx
+async def perform_spin(interaction: discord.Interaction, spin_type: str):
+    with metrics.timed("spin", spin_type=spin_type):
+        await _perform_spin(interaction, spin_type)
+
+async def _perform_spin(interaction: discord.Interaction, spin_type: str):
+    guild_id = str(interaction.guild.id)
+    user_id = str(interaction.user.id)
+    user_name = interaction.user.mention
     
-    async def perform_spin(self, interaction: discord.Interaction, spin_type: str):
-        guild_id = str(interaction.guild.id)
-        user_id = str(interaction.user.id)
-        user_name = interaction.user.mention
-        
-        data = load_data()
-        guild_id_str = str(guild_id)
-        
-        if guild_id_str not in data:
-            data = get_guild_data(guild_id)
-            guild_id_str = str(guild_id)
-        
-        today = str(date.today())
-        
-        if user_id not in data[guild_id_str]["daily_spins"]:
-            data[guild_id_str]["daily_spins"][user_id] = {"date": today, "count": 0}
-        elif data[guild_id_str]["daily_spins"][user_id]["date"] != today:
-            data[guild_id_str]["daily_spins"][user_id] = {"date": today, "count": 0}
-        
-        daily_spins = data[guild_id_str]["daily_spins"][user_id]["count"]
-        daily_limit = data[guild_id_str]["settings"]["daily_spin_limit"]
-        
-        if daily_spins >= daily_limit:
-            embed = discord.Embed(title="❌ لقد وصلت للحد اليومي", color=discord.Color.red())
-            embed.add_field(name="السحب المتبقي اليوم", value="0", inline=False)
-            embed.add_field(name="الحد اليومي", value=f"{daily_limit}", inline=False)
-            embed.add_field(name="⏰ التوقيت", value="سيعود العداد صفر غداً", inline=False)
-            await interaction.response.send_message(embed=embed, ephemeral=True)
-            return
-        
-        if spin_type == "normal":
-            prizes = data[guild_id_str]["normal_prizes"]
-            if not prizes:
-                await interaction.response.send_message("❌ لا توجد جوائز متاحة!", ephemeral=True)
-                return
-            
-            prize = random.choice(prizes)
-            
-        elif spin_type == "vip":
-            prizes = data[guild_id_str]["vip_prizes"]
-            if not prizes:
-                await interaction.response.send_message("❌ لا توجد جوائز VIP متاحة!", ephemeral=True)
-                return
-            
-            prize = random.choice(prizes)
-        
-        data[guild_id_str]["daily_spins"][user_id]["count"] += 1
-        
-        result = {
-            "user": user_name,
-            "type": spin_type,
-            "prize": prize,
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        data[guild_id_str]["spin_results"].append(result)
-        if len(data[guild_id_str]["spin_results"]) > 100:
-            data[guild_id_str]["spin_results"] = data[guild_id_str]["spin_results"][-100:]
-        
-        save_data(data)
-        
-        daily_spins = data[guild_id_str]["daily_spins"][user_id]["count"]
-        spins_remaining = daily_limit - daily_spins
-        
-        embed = discord.Embed(title="🎉 نتيجة الدوران!", color=discord.Color.gold())
-        embed.add_field(name="👤 المستخدم", value=user_name, inline=False)
-        embed.add_field(name="🎯 نوع الدوران", value="عادي" if spin_type == "normal" else "VIP", inline=False)
-        embed.add_field(name="🎁 الجائزة", value=prize, inline=False)
-        embed.add_field(name="🎫 السحب المتبقي اليوم", value=f"{spins_remaining}/{daily_limit}", inline=False)
-        await interaction.response.send_message(embed=embed)
+    # The limit check and the increment happen under the guild lock, so a
+    # double click can never spin past daily_spin_limit
+    async with guild_lock(guild_id):
+        daily_spins = await get_daily_spins(guild_id, user_id)
+        settings = await get_settings(guild_id)
+        daily_limit = settings["daily_spin_limit"]
+        cost = max(0, settings[f"spin_cost_{spin_type}"])
+        prize = None
+        taken = None
+        if daily_spins < daily_limit:
+            taken = await charge_invites(guild_id, user_id, cost) if cost else {"normal": 0, "vip": 0}
+        if taken is not None:
+            prize = await draw_prize(guild_id, spin_type)
+            if prize is None and cost:
+                # Nothing left to win: give the invites back
+                await adjust_invites(guild_id, user_id, taken["normal"], "refund", vip=taken["vip"])
+        if prize is not None:
+            daily_spins = await increment_daily_spins(guild_id, user_id)
+            await add_spin_result(guild_id, {
+                "user": user_name,
+                "user_id": interaction.user.id,
+                "type": spin_type,
+                "prize": prize,
+                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            })
+            await record_spin_stats(guild_id, spin_type, prize, user_id)
+    
+    outcome = "won" if prize is not None else "limit" if daily_spins >= daily_limit else "invites" if taken is None else "empty"
+    metrics.inc("bot_spins_total", guild=guild_id, spin_type=spin_type, outcome=outcome)
+    
+    if daily_spins >= daily_limit and prize is None:
+        embed = discord.Embed(title="❌ لقد وصلت للحد اليومي", color=discord.Color.red())
+        embed.add_field(name="السحب المتبقي اليوم", value="0", inline=False)
+        embed.add_field(name="الحد اليومي", value=f"{daily_limit}", inline=False)
+        embed.add_field(name="⏰ التوقيت", value="سيعود العداد صفر غداً", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    if taken is None:
+        invites = await get_invites(guild_id, user_id)
+        embed = discord.Embed(title="❌ دعواتك غير كافية", color=discord.Color.red())
+        embed.add_field(name="تكلفة الدوران", value=f"{cost} دعوات", inline=False)
+        embed.add_field(name="دعواتك", value=f"{invites['normal'] + invites['vip']}", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    if prize is None:
+        if spin_type == "vip":
+            await interaction.response.send_message("❌ لا توجد جوائز VIP متاحة!", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ لا توجد جوائز متاحة!", ephemeral=True)
+        return
+    
+    spins_remaining = daily_limit - daily_spins
+    
+    embed = discord.Embed(title="🎉 نتيجة الدوران!", color=discord.Color.gold())
+    embed.add_field(name="👤 المستخدم", value=user_name, inline=False)
+    embed.add_field(name="🎯 نوع الدوران", value="عادي" if spin_type == "normal" else "VIP", inline=False)
+    embed.add_field(name="🎁 الجائزة", value=prize, inline=False)
+    embed.add_field(name="🎫 السحب المتبقي اليوم", value=f"{spins_remaining}/{daily_limit}", inline=False)
+    if cost:
+        embed.add_field(name="🎟️ التكلفة", value=f"-{cost} دعوات", inline=False)
+    await interaction.response.send_message(embed=embed)
+
+# Spin throttling: a token bucket per (guild, user) in front of the spin buttons. Clicks
+# beyond the burst are answered right away, before any storage access
+SPIN_RATE = float(os.getenv("BOT_SPIN_RATE", "0.5"))
+SPIN_BURST = float(os.getenv("BOT_SPIN_BURST", "3"))
+
+class TokenBucketLimiter:
+    """Each key gets `burst` tokens refilled at `rate` per second; a call costs one token.
+    Buckets idle long enough to be full again carry no state and are evicted"""
+    def __init__(self, rate, burst, sweep_interval=60):
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval
+        self.buckets = {}
+        self.last_sweep = time.monotonic()
+        self.allowed = 0
+        self.shed = 0
+    
+    def allow(self, key):
+        now = time.monotonic()
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            self.shed += 1
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        self.allowed += 1
+        return True
     
-    @discord.ui.button(label="🎯 عادي", style=discord.ButtonStyle.green)
-    async def normal_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.perform_spin(interaction, "normal")
+    def sweep(self, now):
+        idle = self.burst / self.rate if self.rate > 0 else float("inf")
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < idle}
+        self.last_sweep = now
+
+spin_limiter = TokenBucketLimiter(SPIN_RATE, SPIN_BURST)
+
+# Spin buttons are dynamic items: the custom_id carries the guild and the tier, so a
+# single registration (setup_hook) serves every spin message, including ones posted
+# before a restart, and no View object is kept per message
+class SpinButton(discord.ui.DynamicItem[Button], template=r"spin:(?P<guild_id>[0-9]+):(?P<spin_type>normal|vip)"):
+    def __init__(self, guild_id, spin_type):
+        if spin_type == "vip":
+            button = Button(label="👑 VIP", style=discord.ButtonStyle.blurple, custom_id=f"spin:{guild_id}:vip")
+        else:
+            button = Button(label="🎯 عادي", style=discord.ButtonStyle.green, custom_id=f"spin:{guild_id}:normal")
+        super().__init__(button)
+        self.guild_id = int(guild_id)
+        self.spin_type = spin_type
     
-    @discord.ui.button(label="👑 VIP", style=discord.ButtonStyle.blurple)
-    async def vip_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.perform_spin(interaction, "vip")
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match):
+        return cls(match["guild_id"], match["spin_type"])
+    
+    async def callback(self, interaction: discord.Interaction):
+        if interaction.guild is None or interaction.guild.id != self.guild_id:
+            await interaction.response.send_message("❌ هذا الزر لا يخص هذا السيرفر", ephemeral=True)
+            return
+        if not spin_limiter.allow((self.guild_id, interaction.user.id)):
+            metrics.inc("bot_spin_shed_total", guild=self.guild_id)
+            await interaction.response.send_message("⏳ تمهّل قليلاً قبل الدوران مرة أخرى", ephemeral=True)
+            return
+        await perform_spin(interaction, self.spin_type)
+
+class SpinView(View):
+    def __init__(self, guild_id):
+        super().__init__(timeout=None)
+        self.add_item(SpinButton(guild_id, "normal"))
+        self.add_item(SpinButton(guild_id, "vip"))
 
 @bot.command(name="spin", description="دوران العجلة!")
 async def spin(ctx):
-    if not is_ticket_channel(ctx.channel):
+    if not await is_ticket_channel(ctx.channel):
         embed = discord.Embed(title="❌ لا يمكن استخدام هذا الأمر هنا", color=discord.Color.red())
         embed.description = "هذا الأمر متاح فقط داخل التذاكر"
         embed.add_field(name="📍 أين تستخدمه؟", value="استخدم الأمر فقط في قنوات التذاكر", inline=False)
@@ -504,85 +3137,116 @@ async def spin(ctx):
     embed.add_field(name="🎯 عادي", value="دوران عادي", inline=True)
     embed.add_field(name="👑 VIP", value="دوران VIP", inline=True)
     
-    view = SpinView(ctx)
+    view = SpinView(ctx.guild.id)
     await ctx.send(embed=embed, view=view)
 
-@bot.tree.command(name="prizes", description="عرض الجوائز المتاحة")
-async def view_prizes(interaction: discord.Interaction):
-    guild_id = str(interaction.guild.id)
-    data = get_guild_data(guild_id)
+async def prizes_embed(guild_id):
+    normal_prizes = await get_prizes(guild_id, "normal")
+    vip_prizes = await get_prizes(guild_id, "vip")
     
     embed = discord.Embed(title="🎁 الجوائز المتاحة", color=discord.Color.purple())
     
-    if data[guild_id]["normal_prizes"]:
-        embed.add_field(name="الجوائز العادية", value="\n".join(data[guild_id]["normal_prizes"]), inline=False)
+    if normal_prizes:
+        embed.add_field(name="الجوائز العادية", value=format_prizes(normal_prizes), inline=False)
     else:
         embed.add_field(name="الجوائز العادية", value="لم يتم تعيين جوائز", inline=False)
     
-    if data[guild_id]["vip_prizes"]:
-        embed.add_field(name="جوائز VIP", value="\n".join(data[guild_id]["vip_prizes"]), inline=False)
+    if vip_prizes:
+        embed.add_field(name="جوائز VIP", value=format_prizes(vip_prizes), inline=False)
     else:
         embed.add_field(name="جوائز VIP", value="لم يتم تعيين جوائز", inline=False)
-    
+    return embed
+
+@bot.tree.command(name="prizes", description="عرض الجوائز المتاحة")
+async def view_prizes(interaction: discord.Interaction):
+    guild_id = str(interaction.guild.id)
+    embed = await cached_embed("prizes", guild_id, lambda: prizes_embed(guild_id))
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+async def help_main_embed():
+    embed = discord.Embed(title="📖 قائمة المساعدة الرئيسية", color=discord.Color.blue())
+    embed.description = "اختر فئة الأوامر التي تريد معرفة المزيد عنها"
+    return embed
+
+async def help_admin_embed():
+    embed = discord.Embed(title="👑 أوامر المسؤول", color=discord.Color.red(), description="الأوامر المتاحة للمسؤولين فقط")
+    embed.add_field(name="━━━━━━━━ إدارة الدعوات ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="/add-invites", value="إضافة دعوات لمستخدم", inline=False)
+    embed.add_field(name="/remove-invites", value="حذف دعوات من مستخدم", inline=False)
+    embed.add_field(name="/bulk-invites", value="تعديل دعوات عدة مستخدمين من ملف CSV أو JSON", inline=False)
+    embed.add_field(name="/set-invite-log", value="تعيين قناة سجل الدعوات", inline=False)
+    embed.add_field(name="/invites-audit", value="مطابقة أرصدة الدعوات مع سجل العمليات", inline=False)
+    embed.add_field(name="━━━━━━━━ إدارة الجوائز ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="/set-normal-prizes", value="تعيين الجوائز العادية (5 جوائز)", inline=False)
+    embed.add_field(name="/set-vip-prizes", value="تعيين جوائز VIP (5 جوائز)", inline=False)
+    embed.add_field(name="/set-prize", value="إضافة جائزة بوزن وكمية محددة", inline=False)
+    embed.add_field(name="/remove-prize", value="حذف جائزة من العجلة", inline=False)
+    embed.add_field(name="━━━━━━━━ إعدادات الدوران ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="/spin-settings", value="عرض إعدادات الدوران الكاملة", inline=False)
+    embed.add_field(name="/set-spin-invites", value="تعيين تكلفة الدوران (عادي/VIP)", inline=False)
+    embed.add_field(name="/set-daily-limit", value="تحديد عدد مرات السحب اليومي", inline=False)
+    embed.add_field(name="/set-ticket-patterns", value="تحديد الكلمات التي تُعرف بها قنوات التذاكر", inline=False)
+    embed.add_field(name="/ticket-category", value="إضافة أو إزالة كاتيجوري تذاكر", inline=False)
+    embed.add_field(name="/spin-results", value="عرض آخر 10 نتائج دورانات", inline=False)
+    embed.add_field(name="/spin-stats", value="إحصائيات الدوران: الجوائز الأكثر ظهوراً والدورانات اليومية والأعضاء الأكثر نشاطاً", inline=False)
+    embed.add_field(name="━━━━━━━━ إعدادات البوت ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="/bot-avatar", value="تعيين صورة البوت (رابط صورة)", inline=False)
+    embed.add_field(name="/set-streaming", value="تعيين حالة البث للبوت", inline=False)
+    return embed
+
+async def help_user_embed():
+    embed = discord.Embed(title="📚 الأوامر العامة", color=discord.Color.green(), description="الأوامر المتاحة للجميع")
+    embed.add_field(name="━━━━━━━━ أوامر الدوران ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="!invites", value="عرض عدد دعواتك (عادي و VIP)", inline=False)
+    embed.add_field(name="!spin", value="دوران العجلة مع اختيار النوع (عادي/VIP)", inline=False)
+    embed.add_field(name="/prizes", value="عرض جميع الجوائز المتاحة", inline=False)
+    embed.add_field(name="/invites-leaderboard", value="ترتيب الأعضاء حسب عدد الدعوات", inline=False)
+    embed.add_field(name="━━━━━━━━ معلومات ودعم ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="/help", value="عرض قائمة المساعدة هذه", inline=False)
+    embed.add_field(name="/support", value="الحصول على الدعم والمساعدة", inline=False)
+    embed.add_field(name="/join-voice", value="الانضمام لقناة صوتية", inline=False)
+    embed.add_field(name="━━━━━━━━ معلومات إضافية ━━━━━━━━", value="", inline=False)
+    embed.add_field(name="💡 ملاحظات مهمة", value="• لكل عضو حد يومي للسحب\n• كل سحب يكلف دعوات\n• النتائج تظهر في القناة للجميع", inline=False)
+    return embed
+
+# Help views are persistent: bot.add_view registers one instance of each in setup_hook
+# and it answers the fixed custom_ids on every help message. Copies sent with a
+# message are detached, so nothing is stored per message
+def detached(view):
+    """A stopped view is sent with the message but not kept in the view store"""
+    view.stop()
+    return view
+
 class MainHelpView(View):
     def __init__(self):
-        super().__init__()
+        super().__init__(timeout=None)
     
-    @discord.ui.button(label="👑 أوامر الأونر", style=discord.ButtonStyle.blurple)
+    @discord.ui.button(label="👑 أوامر الأونر", style=discord.ButtonStyle.blurple, custom_id="help:admin")
     async def admin_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        embed = discord.Embed(title="👑 أوامر المسؤول", color=discord.Color.red(), description="الأوامر المتاحة للمسؤولين فقط")
-        embed.add_field(name="━━━━━━━━ إدارة الدعوات ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="/add-invites", value="إضافة دعوات لمستخدم", inline=False)
-        embed.add_field(name="/remove-invites", value="حذف دعوات من مستخدم", inline=False)
-        embed.add_field(name="/set-invite-log", value="تعيين قناة سجل الدعوات", inline=False)
-        embed.add_field(name="━━━━━━━━ إدارة الجوائز ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="/set-normal-prizes", value="تعيين الجوائز العادية (5 جوائز)", inline=False)
-        embed.add_field(name="/set-vip-prizes", value="تعيين جوائز VIP (5 جوائز)", inline=False)
-        embed.add_field(name="━━━━━━━━ إعدادات الدوران ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="/spin-settings", value="عرض إعدادات الدوران الكاملة", inline=False)
-        embed.add_field(name="/set-spin-invites", value="تعيين تكلفة الدوران (عادي/VIP)", inline=False)
-        embed.add_field(name="/set-daily-limit", value="تحديد عدد مرات السحب اليومي", inline=False)
-        embed.add_field(name="/spin-results", value="عرض آخر 10 نتائج دورانات", inline=False)
-        embed.add_field(name="━━━━━━━━ إعدادات البوت ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="/bot-avatar", value="تعيين صورة البوت (رابط صورة)", inline=False)
-        embed.add_field(name="/set-streaming", value="تعيين حالة البث للبوت", inline=False)
-        view = BackHelpView()
+        embed = await cached_embed("help:admin", None, help_admin_embed)
+        view = detached(BackHelpView())
         await interaction.response.edit_message(embed=embed, view=view)
     
-    @discord.ui.button(label="📚 أوامر عامة", style=discord.ButtonStyle.green)
+    @discord.ui.button(label="📚 أوامر عامة", style=discord.ButtonStyle.green, custom_id="help:user")
     async def user_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        embed = discord.Embed(title="📚 الأوامر العامة", color=discord.Color.green(), description="الأوامر المتاحة للجميع")
-        embed.add_field(name="━━━━━━━━ أوامر الدوران ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="!invites", value="عرض عدد دعواتك (عادي و VIP)", inline=False)
-        embed.add_field(name="!spin", value="دوران العجلة مع اختيار النوع (عادي/VIP)", inline=False)
-        embed.add_field(name="/prizes", value="عرض جميع الجوائز المتاحة", inline=False)
-        embed.add_field(name="━━━━━━━━ معلومات ودعم ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="/help", value="عرض قائمة المساعدة هذه", inline=False)
-        embed.add_field(name="/support", value="الحصول على الدعم والمساعدة", inline=False)
-        embed.add_field(name="/join-voice", value="الانضمام لقناة صوتية", inline=False)
-        embed.add_field(name="━━━━━━━━ معلومات إضافية ━━━━━━━━", value="", inline=False)
-        embed.add_field(name="💡 ملاحظات مهمة", value="• لكل عضو حد يومي للسحب\n• كل سحب يكلف دعوات\n• النتائج تظهر في القناة للجميع", inline=False)
-        view = BackHelpView()
+        embed = await cached_embed("help:user", None, help_user_embed)
+        view = detached(BackHelpView())
         await interaction.response.edit_message(embed=embed, view=view)
 
 class BackHelpView(View):
     def __init__(self):
-        super().__init__()
+        super().__init__(timeout=None)
     
-    @discord.ui.button(label="🔙 رجوع", style=discord.ButtonStyle.gray)
+    @discord.ui.button(label="🔙 رجوع", style=discord.ButtonStyle.gray, custom_id="help:back")
     async def back_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        embed = discord.Embed(title="📖 قائمة المساعدة الرئيسية", color=discord.Color.blue())
-        embed.description = "اختر فئة الأوامر التي تريد معرفة المزيد عنها"
-        view = MainHelpView()
+        embed = await cached_embed("help:main", None, help_main_embed)
+        view = detached(MainHelpView())
         await interaction.response.edit_message(embed=embed, view=view)
 
 @bot.tree.command(name="help", description="قائمة المساعدة")
 async def help_command(interaction: discord.Interaction):
-    embed = discord.Embed(title="📖 قائمة المساعدة الرئيسية", color=discord.Color.blue())
-    embed.description = "اختر فئة الأوامر التي تريد معرفة المزيد عنها"
-    view = MainHelpView()
+    embed = await cached_embed("help:main", None, help_main_embed)
+    view = detached(MainHelpView())
     await interaction.response.send_message(embed=embed, view=view)
 
 @bot.tree.command(name="support", description="الحصول على الدعم")
@@ -591,14 +3255,19 @@ async def support_command(interaction: discord.Interaction):
     embed.add_field(name="هل تحتاج مساعدة؟", value="تواصل مع مسؤولي السيرفر", inline=False)
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
-@bot.tree.command(name="about", description="معلومات عن البوت")
-async def about_command(interaction: discord.Interaction):
+async def about_embed():
     embed = discord.Embed(title="ℹ️ معلومات البوت", color=discord.Color.blurple())
     embed.add_field(name="🤖 اسم البوت", value=f"{bot.user.name}", inline=False)
     embed.add_field(name="👨‍💻 Developer", value="**Mujahid**", inline=False)
     embed.add_field(name="📝 الوصف", value="نظام إدارة متقدم للعجلة والجوائز مع تتبع الدعوات", inline=False)
     embed.add_field(name="⚙️ الميزات", value="• نظام دوران العجلة\n• تتبع تلقائي للدعوات\n• إدارة الجوائز\n• حد يومي للسحب\n• دعم صوتي", inline=False)
     embed.set_thumbnail(url=bot.user.avatar.url if bot.user.avatar else None)
+    return embed
+
+@bot.tree.command(name="about", description="معلومات عن البوت")
+async def about_command(interaction: discord.Interaction):
+    avatar_url = bot.user.avatar.url if bot.user.avatar else None
+    embed = await cached_embed(f"about:{avatar_url}", None, about_embed)
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="join-voice", description="الانضمام لقناة صوتية")
@@ -636,10 +3305,62 @@ async def join_voice(interaction: discord.Interaction, channel: discord.VoiceCha
         except:
             await interaction.followup.send(f"❌ خطأ: {str(e)}")
 
+def launch(shard_count, process_count):
+    """Run one bot process per contiguous range of shards and wait for all of them"""
+    processes = []
+    for index in range(process_count):
+        shard_ids = range(index * shard_count // process_count, (index + 1) * shard_count // process_count)
+        env = dict(os.environ, BOT_SHARD_COUNT=str(shard_count), BOT_SHARD_IDS=",".join(map(str, shard_ids)))
+        if METRICS_PORT:
+            # One metrics port per process
+            env["BOT_METRICS_PORT"] = str(METRICS_PORT + index)
+        print(f"🚀 Process {index}: shards {shard_ids.start}-{shard_ids.stop - 1} of {shard_count}")
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+    return max(process.returncode for process in processes)
+
 # Run the bot
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands_parser = parser.add_subparsers(dest="command")
+    import_parser = commands_parser.add_parser("import-json", help="import bot_data.json into the configured storage")
+    import_parser.add_argument("json_file", nargs="?", default=DATA_FILE)
+    launch_parser = commands_parser.add_parser("launch", help="run the bot as several sharded processes")
+    launch_parser.add_argument("--shards", type=int, required=True)
+    launch_parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+    
+    if args.command == "import-json":
+        # Covers every shard, so each guild lands in the file of the shard that owns it
+        target = build_store(None, SHARD_COUNT)
+        target.load()
+        guilds = {str(guild_id): guild.to_json() for guild_id, guild in JsonStore(args.json_file).load().items()}
+        target.import_guilds(guilds)
+        # Imported balances replace the old ones; the ledger records the difference
+        for guild_id in guilds:
+            invite_ledger.reconcile(guild_id, target.invite_balances(guild_id), "import")
+        target.close()
+        print(f"✅ Imported {len(guilds)} guild(s) from {args.json_file} ({STORAGE_BACKEND})")
+        exit(0)
+    
+    if args.command == "launch":
+        if args.shards < 1 or not 1 <= args.processes <= args.shards:
+            print("❌ Error: need at least one shard and between 1 and --shards processes")
+            exit(1)
+        exit(launch(args.shards, args.processes))
+    
     bot_token = os.getenv("DISCORD_BOT_TOKEN")
     if not bot_token:
         print("❌ Error: DISCORD_BOT_TOKEN environment variable not set")
         exit(1)
-    bot.run(bot_token)
+    try:
+        bot.run(bot_token)
+    finally:
+        close_storage()